@@ -0,0 +1,214 @@
+# Copyright 2013-2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Keeps an append-only journal of scan progress, so scans can be resumed.
+
+Every line of the journal has the form
+
+    <timestamp> <event> <scan> <fingerprint>
+
+where <scan> is the "+"-joined list of module names, and <event> is one of:
+
+    start   A new scan began (the fingerprint is "-").
+    built   The circuit to the exit relay was built.
+    failed  The circuit to the exit relay failed.
+    done    The module finished running over the exit relay.
+"""
+
+import os
+import time
+import logging
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+# Buffered records are written to disk at least this often (in seconds)...
+
+FLUSH_INTERVAL = 1
+
+# ...or as soon as this many records are buffered.
+
+FLUSH_RECORDS = 256
+
+JOURNAL_NAME = "exitmap-journal.log"
+
+
+def journal_path(analysis_dir):
+    """
+    Return the path of the journal in the given analysis directory.
+    """
+
+    if analysis_dir is None:
+        analysis_dir = tempfile.gettempdir()
+
+    return os.path.join(analysis_dir, JOURNAL_NAME)
+
+
+def read_journal(path):
+    """
+    Return a list of (timestamp, event, scan, fingerprint) tuples.
+
+    Lines that cannot be parsed -- e.g., a line that was only partially
+    written before exitmap was killed -- are skipped.
+    """
+
+    records = []
+
+    try:
+        with open(path) as fd:
+            for line in fd:
+                fields = line.split()
+                if len(fields) != 4:
+                    continue
+                try:
+                    timestamp = float(fields[0])
+                except ValueError:
+                    continue
+                records.append((timestamp, fields[1], fields[2], fields[3]))
+    except IOError as err:
+        log.debug("Could not read journal \"%s\": %s" % (path, err))
+
+    return records
+
+
+def finished_exits(path, scan):
+    """
+    Return the set of exit relays that the most recent run of `scan' finished.
+    """
+
+    finished = set()
+
+    for _, event, record_scan, fpr in read_journal(path):
+        if record_scan != scan:
+            continue
+        if event == "start":
+            finished = set()
+        elif event == "done":
+            finished.add(fpr)
+
+    return finished
+
+
+def exit_history(path):
+    """
+    Summarise the journal's records per exit relay, across all scans.
+
+    Returns a dictionary mapping fingerprints to (time of last completed probe,
+    number of failed circuits) tuples.
+    """
+
+    history = {}
+
+    for timestamp, event, _, fpr in read_journal(path):
+        last_done, failures = history.get(fpr, (0, 0))
+        if event == "done":
+            history[fpr] = (max(last_done, timestamp), failures)
+        elif event == "failed":
+            history[fpr] = (last_done, failures + 1)
+
+    history.pop("-", None)
+
+    return history
+
+
+class Journal(object):
+
+    """
+    Append records to the journal of the given scan.
+
+    Records are buffered in memory and written by a background thread, so
+    that recording an event costs the event handler no more than appending to
+    a list.
+    """
+
+    def __init__(self, path, scan):
+
+        self.scan = scan
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.fd = open(path, "a+")
+
+        # If we were killed while writing a record, the journal does not end
+        # with a newline, and our first record must not extend the torn one.
+
+        if self.fd.tell() > 0:
+            self.fd.seek(self.fd.tell() - 1)
+            if self.fd.read(1) != "\n":
+                self.fd.write("\n")
+
+        log.debug("Journaling scan progress to \"%s\"." % path)
+
+        self.thread = threading.Thread(target=self.writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, event, fpr="-"):
+        """
+        Buffer a record of the given event for the given exit relay.
+        """
+
+        line = "%.3f %s %s %s\n" % (time.time(), event, self.scan, fpr)
+
+        with self.lock:
+            self.buffer.append(line)
+            if len(self.buffer) >= FLUSH_RECORDS:
+                self.wakeup.set()
+
+    def flush(self):
+        """
+        Write all buffered records to disk.
+        """
+
+        with self.lock:
+            lines, self.buffer = self.buffer, []
+
+        if lines:
+            self.fd.write("".join(lines))
+            self.fd.flush()
+
+    def writer(self):
+        """
+        Periodically flush buffered records until the journal is closed.
+        """
+
+        while not self.closed:
+            self.wakeup.wait(FLUSH_INTERVAL)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except (IOError, ValueError) as err:
+                log.warning("Could not write to journal: %s" % err)
+
+    def close(self):
+        """
+        Flush all remaining records and close the journal.
+        """
+
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        self.fd.close()
@@ -59,6 +59,10 @@ class Command(object):
 
     """
     Provide an abstraction for a shell command which is to be run.
+
+    The command authenticates to Tor's SOCKS port with the SOCKS user name of
+    its circuit.  Unless `queue' is None, the command's connections to Tor's
+    SOCKS port are also reported over it.
     """
 
     def __init__(self, queue, circ_id, socks_port):
@@ -110,7 +114,7 @@ class Command(object):
                           "from [^:]+:([0-9]{1,5})"
                 port = util.extract_pattern(line, pattern)
 
-                if port:
+                if port and self.queue is not None:
                     self.queue.put([self.circ_id, ("127.0.0.1", int(port))])
 
                 keep_reading = self.output_callback(line, self.process.kill)
@@ -130,7 +134,7 @@ class Command(object):
         # We run the given command in a separate thread.  The main thread will
         # kill the process if it does not finish before the given timeout.
 
-        with tempfile.NamedTemporaryFile(prefix="torsocks_") as fd:
+        with tempfile.NamedTemporaryFile(mode="w", prefix="torsocks_") as fd:
 
             log.debug("Created temporary torsocks config file %s" % fd.name)
             os.environ["TORSOCKS_CONF_FILE"] = fd.name
@@ -138,6 +142,9 @@ class Command(object):
 
             fd.write("TorPort %d\n" % self.socks_port)
             fd.write("TorAddress 127.0.0.1\n")
+            fd.write("SOCKS5Username %s\n" %
+                     torsocks.socks_username(self.circ_id))
+            fd.write("SOCKS5Password %s\n" % torsocks.SOCKS_PASSWORD)
             fd.flush()
 
             log.debug("Invoking \"%s\" in environment:\n%s" %
@@ -0,0 +1,298 @@
+# Copyright 2013-2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Splits one scan across several exitmap workers by leasing out exit relays.
+
+A coordinator owns the list of exit relays to scan.  Workers lease a few
+exit relays at a time over HTTP, renew their lease while they are probing,
+and report completion when they are done.  If a worker does not renew its
+lease in time, the lease expires and its exit relays are leased out again.
+
+The coordinator understands three POST requests, all of which take and
+return JSON objects:
+
+    /lease     {"worker": str}             -> {"lease": str, "exits": [str],
+                                               "ttl": float, "done": bool}
+    /renew     {"lease": str}              -> {"ok": bool}
+    /complete  {"lease": str}              -> {"ok": bool}
+"""
+
+import json
+import time
+import uuid
+import logging
+import threading
+import collections
+import urllib.request
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+log = logging.getLogger(__name__)
+
+
+class LeaseTable(object):
+
+    """
+    Keep track of which exit relays are pending, leased, and done.
+    """
+
+    def __init__(self, fingerprints, lease_size, ttl):
+
+        self.pending = collections.deque(fingerprints)
+        self.lease_size = max(1, lease_size)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+        # Maps lease IDs to (worker, fingerprints, expiry time) tuples.
+
+        self.leases = {}
+        self.done = set()
+
+    def _expire(self, now):
+        """
+        Return the exit relays of expired leases to the pending queue.
+
+        Must be called with the lock held.
+        """
+
+        for lease_id, (worker, fprs, expiry) in list(self.leases.items()):
+            if expiry <= now:
+                log.info("Lease %s of worker %s expired.  Reissuing its %d "
+                         "exit relay(s)." % (lease_id, worker, len(fprs)))
+                del self.leases[lease_id]
+                self.pending.extendleft(reversed(fprs))
+
+    def lease(self, worker, now=None):
+        """
+        Lease pending exit relays to the given worker.
+
+        Returns a (lease ID, fingerprints) tuple.  If nothing is pending, the
+        lease ID is None and the list is empty.
+        """
+
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            self._expire(now)
+
+            if not self.pending:
+                return None, []
+
+            fprs = []
+            while self.pending and len(fprs) < self.lease_size:
+                fprs.append(self.pending.popleft())
+
+            lease_id = uuid.uuid4().hex
+            self.leases[lease_id] = (worker, fprs, now + self.ttl)
+            log.debug("Leased %d exit relay(s) to worker %s." %
+                      (len(fprs), worker))
+
+            return lease_id, fprs
+
+    def renew(self, lease_id, now=None):
+        """
+        Extend the given lease.  Returns False if the lease already expired.
+        """
+
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            self._expire(now)
+
+            if lease_id not in self.leases:
+                return False
+
+            worker, fprs, _ = self.leases[lease_id]
+            self.leases[lease_id] = (worker, fprs, now + self.ttl)
+
+            return True
+
+    def complete(self, lease_id, now=None):
+        """
+        Mark the exit relays of the given lease as done.
+
+        Returns False if the lease already expired, in which case its exit
+        relays may have been leased to another worker.
+        """
+
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            self._expire(now)
+
+            if lease_id not in self.leases:
+                return False
+
+            worker, fprs, _ = self.leases.pop(lease_id)
+            self.done.update(fprs)
+            log.info("Worker %s finished %d exit relay(s); %d done, %d "
+                     "pending, %d leased." %
+                     (worker, len(fprs), len(self.done), len(self.pending),
+                      sum(len(l[1]) for l in self.leases.values())))
+
+            return True
+
+    def finished(self):
+        """
+        Return True if no exit relay is pending or leased anymore.
+        """
+
+        with self.lock:
+            return not self.pending and not self.leases
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    """
+    Translate HTTP requests to LeaseTable calls.
+    """
+
+    def do_POST(self):
+
+        table = self.server.table
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+        except ValueError as err:
+            self.send_error(400, "Malformed request: %s" % err)
+            return
+
+        if self.path == "/lease":
+            lease_id, fprs = table.lease(request.get("worker", "unknown"))
+            reply = {"lease": lease_id, "exits": fprs, "ttl": table.ttl,
+                     "done": lease_id is None and table.finished()}
+        elif self.path == "/renew":
+            reply = {"ok": table.renew(request.get("lease"))}
+        elif self.path == "/complete":
+            reply = {"ok": table.complete(request.get("lease"))}
+        else:
+            self.send_error(404)
+            return
+
+        body = json.dumps(reply).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        log.debug("%s %s" % (self.address_string(), fmt % args))
+
+
+class CoordinatorServer(ThreadingMixIn, HTTPServer):
+
+    """
+    Serve the given LeaseTable over HTTP.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, table, address):
+
+        HTTPServer.__init__(self, address, _RequestHandler)
+        self.table = table
+
+
+class LeaseClient(object):
+
+    """
+    Talk to a coordinator on behalf of a worker.
+    """
+
+    def __init__(self, url, worker, timeout=30):
+
+        self.url = url.rstrip("/")
+        self.worker = worker
+        self.timeout = timeout
+
+    def _post(self, path, request):
+
+        data = json.dumps(request).encode("utf-8")
+        req = urllib.request.Request(self.url + path, data,
+                                     {"Content-Type": "application/json"})
+        reply = urllib.request.urlopen(req, timeout=self.timeout).read()
+
+        return json.loads(reply.decode("utf-8"))
+
+    def lease(self):
+        """
+        Return the coordinator's reply to a lease request.
+        """
+
+        return self._post("/lease", {"worker": self.worker})
+
+    def renew(self, lease_id):
+        """
+        Renew the given lease.  Returns False if it already expired.
+        """
+
+        return self._post("/renew", {"lease": lease_id})["ok"]
+
+    def complete(self, lease_id):
+        """
+        Report the given lease as done.  Returns False if it already expired.
+        """
+
+        return self._post("/complete", {"lease": lease_id})["ok"]
+
+
+class LeaseRenewer(object):
+
+    """
+    Keep renewing a lease in a background thread until stopped.
+    """
+
+    def __init__(self, client, lease_id, ttl):
+
+        self.client = client
+        self.lease_id = lease_id
+        self.interval = ttl / 3.0
+        self.stopped = threading.Event()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """
+        Renew the lease every third of its lifetime.
+        """
+
+        while not self.stopped.wait(self.interval):
+            try:
+                if not self.client.renew(self.lease_id):
+                    log.warning("Lease %s expired before we could renew "
+                                "it." % self.lease_id)
+                    return
+            except (IOError, ValueError) as err:
+                log.warning("Could not renew lease %s: %s" %
+                            (self.lease_id, err))
+
+    def stop(self):
+        """
+        Stop renewing the lease.
+        """
+
+        self.stopped.set()
+        self.thread.join()
@@ -19,21 +19,39 @@
 Handles Tor controller events.
 """
 
-import sys
 import functools
 import threading
-import multiprocessing
 import logging
 
 import stem
+import stem.version
 from stem import StreamStatus
 from stem import CircStatus
 
-import command
+import ipc
 import util
+import torsocks
+from probepool import ProbePool, ProbeLoop, is_async
 
 log = logging.getLogger(__name__)
 
+# Tor versions starting with this one report the SOCKS user name of a stream
+# in its STREAM events.
+
+SOCKS_USERNAME_VERSION = stem.version.Version("0.4.0.1-alpha")
+
+
+def reports_socks_username(controller):
+    """
+    Return True if Tor's STREAM events contain the stream's SOCKS user name.
+    """
+
+    try:
+        return controller.get_version() >= SOCKS_USERNAME_VERSION
+    except stem.ControllerError as err:
+        log.warning("Could not determine Tor's version: %s" % err)
+        return False
+
 
 def get_relay_desc(controller, fpr):
     """
@@ -71,7 +89,7 @@ class Attacher(object):
         Prepare for attaching a stream to a circuit.
 
         If we already have the corresponding stream/circuit, we can attach it
-        now.  Otherwise, the method _attach() is partially executed and stored,
+        now.  Otherwise, the method attach() is partially executed and stored,
         so it can be attached later.
         """
 
@@ -96,17 +114,17 @@ class Attacher(object):
             # function.
 
             if circuit_id:
-                partially_attached = functools.partial(self._attach,
+                partially_attached = functools.partial(self.attach,
                                                        circuit_id=circuit_id)
                 self.unattached[port] = partially_attached
             else:
-                partially_attached = functools.partial(self._attach,
+                partially_attached = functools.partial(self.attach,
                                                        stream_id=stream_id)
                 self.unattached[port] = partially_attached
 
         log.debug("Pending attachers: %d." % len(self.unattached))
 
-    def _attach(self, stream_id=None, circuit_id=None):
+    def attach(self, stream_id=None, circuit_id=None):
         """
         Attach a stream to a circuit.
         """
@@ -120,30 +138,6 @@ class Attacher(object):
             log.warning("Failed to attach stream because: %s" % err)
 
 
-def module_closure(queue, module, circ_id, *module_args, **module_kwargs):
-    """
-    Return function that runs the module and then informs event handler.
-    """
-
-    def func():
-        """
-        Run the module and then inform the event handler.
-
-        The invoking process keeps track of which circuits finished.  Once we
-        are done, we send a signal over the queue to let the process know.
-        """
-
-        try:
-            module(*module_args, **module_kwargs)
-
-            log.debug("Informing event handler that module finished.")
-            queue.put((circ_id, None))
-        except KeyboardInterrupt:
-            pass
-
-    return func
-
-
 class EventHandler(object):
 
     """
@@ -151,25 +145,50 @@ class EventHandler(object):
 
     The handler processes only stream and circuit events.  New streams are
     attached to their corresponding circuits since exitmap's Tor process leaves
-    new streams unattached.
+    new streams unattached.  Probes run in a pool of `probe_workers' processes
+    -- or, if the module is asynchronous, in an event loop -- which the handler
+    starts right away and stops in close().
     """
 
-    def __init__(self, controller, module, socks_port, stats, exit_destinations):
+    def __init__(self, controller, module, socks_port, stats, exit_destinations,
+                 scheduler=None, first_hops=None, journal=None,
+                 probe_workers=32):
 
         self.stats = stats
         self.controller = controller
         self.attacher = Attacher(controller)
         self.module = module
-        self.manager = multiprocessing.Manager()
-        self.queue = self.manager.Queue()
+        self.queue = ipc.Channel()
         self.socks_port = socks_port
+        # If Tor tells us the SOCKS user name of new streams, we attach them
+        # right away, and probes need not report their connections.
+
+        self.isolation = reports_socks_username(controller)
+        if not self.isolation:
+            log.info("Tor does not report SOCKS user names.  Attaching "
+                     "streams by their source port.")
+
+        if is_async(module):
+            self.probes = ProbeLoop(module, self.queue, socks_port,
+                                    report_streams=not self.isolation)
+        else:
+            self.probes = ProbePool(module, self.queue, socks_port,
+                                    probe_workers,
+                                    report_streams=not self.isolation)
         self.exit_destinations = exit_destinations
+        self.scheduler = scheduler
+        self.first_hops = first_hops
+        self.journal = journal
         self.check_finished_lock = threading.Lock()
-        self.already_finished = False
+        self.finished = threading.Event()
+
+        # Maps circuit IDs to the fingerprint of their exit relay.
 
-        queue_thread = threading.Thread(target=self.queue_reader)
-        queue_thread.daemon = False
-        queue_thread.start()
+        self.circuit_exits = {}
+
+        self.queue_thread = threading.Thread(target=self.queue_reader)
+        self.queue_thread.daemon = False
+        self.queue_thread.start()
 
     def queue_reader(self):
         """
@@ -184,7 +203,7 @@ class EventHandler(object):
         while True:
             try:
                 circ_id, sockname = self.queue.get()
-            except EOFError:
+            except (EOFError, OSError):
                 log.debug("IPC queue terminated.")
                 break
 
@@ -193,6 +212,13 @@ class EventHandler(object):
             # its stream attached to a circuit (by sending (circ_id,sockname)).
 
             if sockname is None:
+                exit_fpr = self.circuit_exits.pop(circ_id, "-")
+                if self.journal is not None:
+                    self.journal.record("done", exit_fpr)
+                self.probes.done(circ_id)
+                if self.scheduler is not None:
+                    self.scheduler.probe_finished(circ_id)
+
                 log.debug("Closing finished circuit %s." % circ_id)
                 try:
                     self.controller.close_circuit(circ_id)
@@ -201,24 +227,43 @@ class EventHandler(object):
 
                 self.stats.finished_streams += 1
                 self.stats.print_progress()
-                self.check_finished()
             else:
                 log.debug("Read from queue: %s, %s" % (circ_id, str(sockname)))
                 port = int(sockname[1])
                 self.attacher.prepare(port, circuit_id=circ_id)
-                self.check_finished()
+
+            if self.check_finished():
+                break
+
+    def close(self):
+        """
+        Stop our probe workers and our IPC channel.
+        """
+
+        self.probes.close()
+        self.queue.close()
+        self.queue_thread.join()
+        self.queue.close_reader()
+
+    def circuit_launched(self, circ_id, exit_fpr):
+        """
+        Remember the exit relay of a circuit that we just launched.
+        """
+
+        self.circuit_exits[circ_id] = exit_fpr
 
     def check_finished(self):
         """
-        Check if the scan is finished and if it is, shut down exitmap.
+        Check if the scan is finished and if it is, set our `finished' event.
+
+        Returns True if the scan is finished.
         """
 
-        # This is called from both the queue reader thread and the
-        # main thread, but (if it detects completion) does things that
-        # must only happen once.
+        # This is called from the queue reader thread, stem's event thread, and
+        # the main thread, so we must only signal completion once.
         with self.check_finished_lock:
-            if self.already_finished:
-                sys.exit(0)
+            if self.finished.is_set():
+                return True
 
             # Did all circuits either build or fail?
             circs_done = ((self.stats.failed_circuits +
@@ -237,18 +282,10 @@ class EventHandler(object):
                                               self.stats.finished_streams))
 
             if circs_done and streams_done:
-                self.already_finished = True
-
-                for proc in multiprocessing.active_children():
-                    log.debug("Terminating remaining PID %d." % proc.pid)
-                    proc.terminate()
-
-                if hasattr(self.module, "teardown"):
-                    log.debug("Calling module's teardown() function.")
-                    self.module.teardown()
+                log.debug("All circuits and streams are done.")
+                self.finished.set()
 
-                log.info(self.stats)
-                sys.exit(0)
+            return self.finished.is_set()
 
     def new_circuit(self, circ_event):
         """
@@ -256,6 +293,24 @@ class EventHandler(object):
         """
 
         self.stats.update_circs(circ_event)
+
+        if self.scheduler is not None:
+            if circ_event.status == CircStatus.BUILT:
+                self.scheduler.circuit_built(circ_event.id)
+            elif circ_event.status == CircStatus.FAILED:
+                self.scheduler.circuit_failed(circ_event.id)
+
+        if self.first_hops is not None:
+            if circ_event.status == CircStatus.BUILT:
+                self.first_hops.circuit_built(circ_event.id)
+            elif circ_event.status == CircStatus.FAILED:
+                self.first_hops.circuit_failed(circ_event.id)
+
+        if circ_event.status == CircStatus.FAILED:
+            exit_fpr = self.circuit_exits.pop(circ_event.id, "-")
+            if self.journal is not None:
+                self.journal.record("failed", exit_fpr)
+
         self.check_finished()
 
         if circ_event.status not in [CircStatus.BUILT]:
@@ -263,43 +318,47 @@ class EventHandler(object):
 
         last_hop = circ_event.path[-1]
         exit_fpr = last_hop[0]
+        self.circuit_exits[circ_event.id] = exit_fpr
+        if self.journal is not None:
+            self.journal.record("built", exit_fpr)
+
         log.debug("Circuit for exit relay \"%s\" is built.  "
                   "Now invoking probing module." % exit_fpr)
 
-        run_cmd_over_tor = command.Command(self.queue,
-                                           circ_event.id,
-                                           self.socks_port)
-
         exit_desc = get_relay_desc(self.controller, exit_fpr)
         if exit_desc is None:
             self.controller.close_circuit(circ_event.id)
             return
 
-        module = module_closure(self.queue, self.module.probe,
-                                circ_event.id, exit_desc,
-                                command.run_python_over_tor(self.queue,
-                                                            circ_event.id,
-                                                            self.socks_port),
-                                run_cmd_over_tor,
-                                destinations=self.exit_destinations[exit_fpr])
-
-        proc = multiprocessing.Process(target=module)
-        proc.daemon = True
-        proc.start()
+        self.probes.submit(circ_event.id, exit_desc,
+                           self.exit_destinations[exit_fpr])
 
     def new_stream(self, stream_event):
         """
-        Create a function which is later used to attach a stream to a circuit.
-
-        The attaching cannot be done right now as we do not know the stream's
-        desired circuit ID at this point.  So we set up all we can at this
-        point and wait for the attaching to be done in queue_reader().
+        Attach a new stream to its circuit.
+
+        If the stream's SOCKS user name tells us its circuit, we attach it
+        right away.  Otherwise, we create a function which is later used to
+        attach the stream.  The attaching cannot be done right now as we do
+        not know the stream's desired circuit ID at this point.  So we set up
+        all we can at this point and wait for the attaching to be done in
+        queue_reader().
         """
 
         if stream_event.status not in [StreamStatus.NEW,
                                        StreamStatus.NEWRESOLVE]:
             return
 
+        if self.isolation:
+            circ_id = torsocks.username_circuit(
+                stream_event.keyword_args.get("SOCKS_USERNAME"))
+            if circ_id is not None:
+                self.attacher.attach(stream_id=stream_event.id,
+                                     circuit_id=circ_id)
+                return
+            log.warning("Stream %s has no SOCKS user name of ours." %
+                        stream_event.id)
+
         port = util.get_source_port(str(stream_event))
         if not port:
             log.warning("Couldn't extract source port from stream "
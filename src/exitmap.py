@@ -26,59 +26,239 @@ import socket
 import pkgutil
 import argparse
 import datetime
-import random
 import logging
 from configparser import ConfigParser
 import functools
 import pwd
+import shutil
+import queue
+import threading
+import multiprocessing
 
 import stem
 import stem.connection
 import stem.process
 import stem.descriptor
-from stem.control import Controller, EventType
+from stem.control import Controller, EventType, Listener
 
 import modules
 import error
 import util
 import relayselector
+import exittracker
+import checkpoint
+import coordinator
+import ordering
 
 from eventhandler import EventHandler
 from stats import Statistics
+from scheduler import CircuitScheduler
+from firsthop import FirstHopPool, FirstHopBalancer
+from probepool import is_async
 
 log = logging.getLogger(__name__)
 
+# Number of circuit creations after which we log an updated estimate of how
+# long the remaining circuit creations will take.
+
+ESTIMATE_INTERVAL = 100
+
+# Descriptors tend to arrive in bursts, so in daemon mode, we collect network
+# updates for this many seconds before we select exit relays again.
+
+UPDATE_SETTLE_TIME = 30
+
+# Seconds a worker waits before asking the coordinator again if all remaining
+# exit relays are currently leased to other workers.
+
+LEASE_POLL_INTERVAL = 10
+
+
+# Tor options that exitmap needs.  If we attach to a running Tor process, we
+# set them over the control port.
+
+TOR_OPTIONS = {
+    "LearnCircuitBuildTimeout": "0",
+    "CircuitBuildTimeout": "40",
+    "__DisablePredictedCircuits": "1",
+    "__LeaveStreamsUnattached": "1",
+    "FetchHidServDescriptors": "0",
+    "UseMicroDescriptors": "0",
+}
+
+# Without these options, exitmap doesn't work at all.
+
+REQUIRED_TOR_OPTIONS = frozenset(["__DisablePredictedCircuits",
+                                  "__LeaveStreamsUnattached",
+                                  "UseMicroDescriptors"])
+
+
+class TorInstance(object):
 
-def bootstrap_tor(args):
     """
-    Invoke a Tor process which is subsequently used by exitmap.
+    A Tor process together with the controller that exitmap uses to talk to it.
     """
 
-    log.info("Attempting to invoke Tor process in directory \"%s\".  This "
-             "might take a while." % args.tor_dir)
+    def __init__(self, data_dir, socks_port, controller, scheduler):
+
+        self.data_dir = data_dir
+        self.socks_port = socks_port
+        self.controller = controller
+        self.scheduler = scheduler
+
+
+def clone_data_dir(src_dir, dst_dir):
+    """
+    Copy the cached directory information of a bootstrapped Tor data directory.
+
+    Tor's lock file and control cookie are specific to the process that owns
+    the data directory, so they are not copied.
+    """
+
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+
+    for file_name in os.listdir(src_dir):
+        if file_name in ("lock", "control_auth_cookie"):
+            continue
+
+        src_path = os.path.join(src_dir, file_name)
+        if os.path.isfile(src_path):
+            shutil.copy2(src_path, os.path.join(dst_dir, file_name))
+
+
+def start_tor_instances(args):
+    """
+    Invoke all Tor processes and return their TorInstance objects.
+
+    The first process bootstraps in the given data directory.  All others use
+    a clone of it, so they can reuse its consensus and descriptors.
+    """
 
     if not args.first_hop:
         log.info("No first hop given.  Using randomly determined first "
                  "hops for circuits.")
 
+    count = max(1, args.tor_instances)
+    instances = []
+
+    for i in range(count):
+        if i == 0:
+            data_dir = args.tor_dir
+        else:
+            data_dir = "%s-%d" % (args.tor_dir, i)
+            clone_data_dir(args.tor_dir, data_dir)
+
+        socks_port, control_port = bootstrap_tor(data_dir)
+
+        controller = Controller.from_port(port=control_port)
+        stem.connection.authenticate(controller)
+
+        # Redirect Tor's logging to work around the following problem:
+        # https://bugs.torproject.org/9862
+
+        log.debug("Redirecting Tor's logging to /dev/null.")
+        controller.set_conf("Log", "err file /dev/null")
+
+        # We already have the current consensus, so we don't need additional
+        # descriptors or the streams fetching them.
+
+        controller.set_conf("FetchServerDescriptors", "0")
+
+        # Every instance gets its share of the circuit creation rate, so all
+        # instances together still respect the given build delay.
+
+        scheduler = CircuitScheduler(args.build_delay * count,
+                                     args.delay_noise * count,
+                                     max_window=args.max_pending)
+        instances.append(TorInstance(data_dir, socks_port, controller,
+                                     scheduler))
+
+    return instances
+
+
+def attach_tor(args):
+    """
+    Connect to an already running Tor process and return its TorInstance.
+
+    We make sure that the options exitmap relies on are set, and we use the
+    Tor process's data directory and SOCKS port.  Note that the Tor process
+    must be dedicated to exitmap because it no longer attaches streams
+    itself.
+    """
+
+    try:
+        if args.tor_control_socket:
+            controller = Controller.from_socket_file(args.tor_control_socket)
+        else:
+            controller = Controller.from_port(port=args.tor_control_port)
+        stem.connection.authenticate(controller)
+    except (stem.SocketError, stem.connection.AuthenticationFailure) as err:
+        log.error("Couldn't connect to Tor's control port: %s" % err)
+        sys.exit(1)
+
+    for option, value in TOR_OPTIONS.items():
+        current = controller.get_conf(option, None)
+        if current == value:
+            continue
+
+        log.info("Setting Tor option %s to %s (was %s)." %
+                 (option, value, current))
+        try:
+            controller.set_conf(option, value)
+        except stem.ControllerError as err:
+            if option in REQUIRED_TOR_OPTIONS:
+                log.error("Couldn't set required Tor option %s: %s" %
+                          (option, err))
+                sys.exit(1)
+            log.warning("Couldn't set Tor option %s: %s" % (option, err))
+
+    listeners = controller.get_listeners(Listener.SOCKS)
+    if not listeners:
+        log.error("The Tor process has no SOCKS port.")
+        sys.exit(1)
+    socks_port = listeners[0][1]
+
+    # Relay selection reads the consensus and descriptors from Tor's data
+    # directory, so we use it instead of --tor-dir.
+
+    args.tor_dir = controller.get_conf("DataDirectory")
+    log.info("Attached to Tor process with data directory \"%s\" and SOCKS "
+             "port %d." % (args.tor_dir, socks_port))
+
+    if args.tor_instances > 1:
+        log.warning("Ignoring --tor-instances because we attach to a running "
+                    "Tor process.")
+
+    scheduler = CircuitScheduler(args.build_delay, args.delay_noise,
+                                 max_window=args.max_pending)
+
+    return TorInstance(args.tor_dir, socks_port, controller, scheduler)
+
+
+def bootstrap_tor(data_dir):
+    """
+    Invoke a Tor process which is subsequently used by exitmap.
+    """
+
+    log.info("Attempting to invoke Tor process in directory \"%s\".  This "
+             "might take a while." % data_dir)
+
     ports = {}
     partial_parse_log_lines = functools.partial(util.parse_log_lines, ports)
 
     try:
+        config = {
+            "SOCKSPort": "auto",
+            "ControlPort": "auto",
+            "DataDirectory": data_dir,
+            "CookieAuthentication": "1",
+            "PathsNeededToBuildCircuits": "0.95",
+        }
+        config.update(TOR_OPTIONS)
+
         proc = stem.process.launch_tor_with_config(
-            config={
-                "SOCKSPort": "auto",
-                "ControlPort": "auto",
-                "DataDirectory": args.tor_dir,
-                "CookieAuthentication": "1",
-                "LearnCircuitBuildTimeout": "0",
-                "CircuitBuildTimeout": "40",
-                "__DisablePredictedCircuits": "1",
-                "__LeaveStreamsUnattached": "1",
-                "FetchHidServDescriptors": "0",
-                "UseMicroDescriptors": "0",
-                "PathsNeededToBuildCircuits": "0.95",
-            },
+            config=config,
             timeout=300,
             take_ownership=True,
             completion_percent=75,
@@ -92,6 +272,30 @@ def bootstrap_tor(args):
     return ports["socks"], ports["control"]
 
 
+def parse_first_hops(first_hop):
+    """
+    Return the list of first hop fingerprints in the given argument.
+
+    The argument is either a file containing one fingerprint per line, or a
+    comma-separated list of fingerprints.  Empty lines and lines starting with
+    "#" are ignored.
+    """
+
+    if os.path.isfile(first_hop):
+        with open(first_hop) as fd:
+            lines = fd.read().splitlines()
+    else:
+        lines = first_hop.split(",")
+
+    fingerprints = []
+    for line in lines:
+        line = line.strip().upper()
+        if line and not line.startswith("#") and line not in fingerprints:
+            fingerprints.append(line)
+
+    return fingerprints
+
+
 def parse_cmd_args():
     """
     Parse and return command line arguments.
@@ -145,9 +349,18 @@ def parse_cmd_args():
                        help="File containing the 20-byte fingerprints "
                             "of exit relays to probe, one per line.")
 
-    parser.add_argument("-d", "--build-delay", type=float, default=3,
-                        help="Wait for the given delay (in seconds) between "
-                             "circuit builds.  The default is 3.")
+    parser.add_argument("-d", "--build-delay", type=float, default=0.5,
+                        help="Wait at least the given delay (in seconds) "
+                             "between circuit builds.  This caps the rate at "
+                             "which circuits are created.  The default is "
+                             "0.5.")
+
+    parser.add_argument("-w", "--max-pending", type=int, default=32,
+                        help="Maximum number of circuits that are under "
+                             "construction at the same time.  Within this "
+                             "limit, exitmap adapts the number to the "
+                             "observed circuit failures and build latency.  "
+                             "The default is 32.")
 
     parser.add_argument("-n", "--delay-noise", type=float, default=0,
                         help="Sample random value in [0, DELAY_NOISE) and "
@@ -167,6 +380,28 @@ def parse_cmd_args():
                              "speeds up bootstrapping.  The default is %s." %
                              tor_directory)
 
+    parser.add_argument("--probe-workers", type=int, default=32,
+                        help="Number of worker processes that run probes.  "
+                             "Probes over further circuits wait until a "
+                             "worker is idle.  The workers are split evenly "
+                             "across Tor instances.  The default is 32.")
+
+    parser.add_argument("-N", "--tor-instances", type=int, default=1,
+                        help="Number of Tor processes to split the scan "
+                             "across.  Additional processes use a copy of "
+                             "the data directory given by --tor-dir.  The "
+                             "default is 1.")
+
+    parser.add_argument("--tor-control-port", type=int, default=None,
+                        help="Don't invoke a Tor process but attach to the "
+                             "one listening on the given control port.  The "
+                             "Tor process must be dedicated to exitmap.")
+
+    parser.add_argument("--tor-control-socket", type=str, default=None,
+                        help="Don't invoke a Tor process but attach to the "
+                             "one listening on the given control socket.  "
+                             "The Tor process must be dedicated to exitmap.")
+
     parser.add_argument("-a", "--analysis-dir", type=str,
                         default=None,
                         help="The directory where analysis results are "
@@ -181,7 +416,10 @@ def parse_cmd_args():
     parser.add_argument("-i", "--first-hop", type=str, default=None,
                         help="The 20-byte fingerprint of the Tor relay which "
                              "is used as first hop.  This relay should be "
-                             "under your control.")
+                             "under your control.  To spread circuits over "
+                             "several first hops, give a comma-separated list "
+                             "of fingerprints or a file containing one "
+                             "fingerprint per line.")
 
     parser.add_argument("-o", "--logfile", type=str, default=None,
                         help="Filename to which log output should be written "
@@ -198,6 +436,73 @@ def parse_cmd_args():
                             "BadExit flag.  By default, only good exits are "
                             "scanned.")
 
+    parser.add_argument("-c", "--combine", action="store_true",
+                        help="Run all given modules over one circuit per "
+                             "exit relay instead of running one scan per "
+                             "module.")
+
+    parser.add_argument("-O", "--order", type=str, default="random",
+                        choices=sorted(ordering.POLICIES.keys()),
+                        help="Order in which exit relays are scanned, so that "
+                             "a time-boxed scan covers the most important "
+                             "exit relays first.  'bandwidth' prefers a high "
+                             "consensus weight, 'last-probed' prefers exit "
+                             "relays that were probed longest ago, and "
+                             "'failures' prefers exit relays with the fewest "
+                             "failed circuits.  The latter two use the "
+                             "journal in the analysis directory.  The "
+                             "default is random.")
+
+    parser.add_argument("-r", "--resume", action="store_true",
+                        help="Resume an interrupted scan by skipping the exit "
+                             "relays that the previous run of the same "
+                             "module(s) already finished.  Progress is "
+                             "journaled in the analysis directory.")
+
+    parser.add_argument("-D", "--daemon", action="store_true",
+                        help="Keep running and rescan exit relays as the "
+                             "network changes.  New exit relays and exit "
+                             "relays with a new descriptor are scanned right "
+                             "away.  All given modules are combined as if "
+                             "--combine was given.")
+
+    parser.add_argument("--rescan-interval", type=util.parse_duration,
+                        default="24h",
+                        help="In daemon mode, rescan unchanged exit relays "
+                             "after this duration, e.g., 90m or 6h.  The "
+                             "default is 24h.")
+
+    parser.add_argument("--deadline", type=util.parse_duration, default=None,
+                        help="Finish the scan within this duration, e.g., "
+                             "45m.  Circuit creations are paced to the "
+                             "measured build and probe times, and exit relays "
+                             "that cannot be probed in time are dropped, "
+                             "starting with the last ones in the scan order.  "
+                             "Ignored in daemon, coordinator, and worker "
+                             "mode.")
+
+    parser.add_argument("--serve-leases", type=str, default=None,
+                        metavar="HOST:PORT",
+                        help="Do not scan but act as coordinator: select exit "
+                             "relays and lease them to workers that connect "
+                             "to HOST:PORT.")
+
+    parser.add_argument("--coordinator", type=str, default=None,
+                        metavar="URL",
+                        help="Act as worker: instead of scanning all selected "
+                             "exit relays, scan the exit relays leased by the "
+                             "coordinator at URL, e.g., "
+                             "http://127.0.0.1:8000.")
+
+    parser.add_argument("--lease-size", type=int, default=16,
+                        help="Number of exit relays per lease.  The default "
+                             "is 16.")
+
+    parser.add_argument("--lease-ttl", type=util.parse_duration,
+                        default="10m",
+                        help="Duration after which a lease that the worker "
+                             "did not renew expires.  The default is 10m.")
+
     parser.add_argument("-V", "--version", action="version",
                         version="%(prog)s 2020.11.23")
 
@@ -228,9 +533,15 @@ def main():
     stats = Statistics()
     args = parse_cmd_args()
 
+    # The deadline includes the time it takes to bootstrap Tor.
+
+    if args.deadline:
+        scan_deadline = time.time() + args.deadline
+
     # Create and set the given directories.
 
-    if args.tor_dir and not os.path.exists(args.tor_dir):
+    attach = args.tor_control_port or args.tor_control_socket
+    if args.tor_dir and not attach and not os.path.exists(args.tor_dir):
         os.makedirs(args.tor_dir)
 
     logging.getLogger("stem").setLevel(logging.__dict__[args.verbosity.upper()])
@@ -241,41 +552,193 @@ def main():
 
     log.debug("Command line arguments: %s" % str(args))
 
-    socks_port, control_port = bootstrap_tor(args)
-    controller = Controller.from_port(port=control_port)
-    stem.connection.authenticate(controller)
+    if args.first_hop:
+        try:
+            args.first_hop = parse_first_hops(args.first_hop)
+        except IOError as err:
+            log.critical("Could not read first hops: %s" % err)
+            return 1
 
-    # Redirect Tor's logging to work around the following problem:
-    # https://bugs.torproject.org/9862
+    if attach:
+        instances = [attach_tor(args)]
+    else:
+        instances = start_tor_instances(args)
 
-    log.debug("Redirecting Tor's logging to /dev/null.")
-    controller.set_conf("Log", "err file /dev/null")
+    cached_consensus_path = os.path.join(args.tor_dir, "cached-consensus")
+    if args.first_hop:
+        found = util.relays_in_consensus(args.first_hop,
+                                         cached_consensus_path)
+        missing = [fpr for fpr in args.first_hop if fpr not in found]
+        if missing:
+            log.critical("Given first hop(s) \"%s\" not found in consensus.  "
+                         "Are they offline?" % ", ".join(missing))
+            return 1
+
+    if args.daemon or args.coordinator or args.serve_leases:
+        if args.analysis_dir is not None:
+            util.analysis_dir = args.analysis_dir
 
-    # We already have the current consensus, so we don't need additional
-    # descriptors or the streams fetching them.
+    if args.deadline and (args.daemon or args.coordinator or
+                          args.serve_leases):
+        log.warning("Ignoring --deadline because it only applies to single "
+                    "scans.")
 
-    controller.set_conf("FetchServerDescriptors", "0")
+    if args.daemon:
+        return run_daemon(args, instances, stats)
+    elif args.serve_leases:
+        return run_coordinator(args, stats)
+    elif args.coordinator:
+        return run_worker(args, instances, stats)
 
-    cached_consensus_path = os.path.join(args.tor_dir, "cached-consensus")
-    if args.first_hop and (not util.relay_in_consensus(args.first_hop,
-                                                       cached_consensus_path)):
-        log.critical("Given first hop \"%s\" not found in consensus.  Is it"
-                     " offline?" % args.first_hop)
-        return 1
+    # In combined mode, all modules share one scan.  Otherwise, we run one
+    # scan per module.
+
+    if args.combine:
+        scans = [args.module]
+    else:
+        scans = [[module_name] for module_name in args.module]
+
+    for i, module_names in enumerate(scans):
 
-    for module_name in args.module:
+        # The scans that are left share the remaining time equally.
+
+        deadline = None
+        if args.deadline:
+            now = time.time()
+            deadline = now + (scan_deadline - now) / (len(scans) - i)
 
         if args.analysis_dir is not None:
-            datestr = time.strftime("%Y-%m-%d_%H:%M:%S%z") + "_" + module_name
+            datestr = time.strftime("%Y-%m-%d_%H:%M:%S%z") + "_" + \
+                      "+".join(module_names)
             util.analysis_dir = os.path.join(args.analysis_dir, datestr)
 
         try:
-            run_module(module_name, args, controller, socks_port, stats)
+            run_module(module_names, args, instances, stats,
+                       deadline=deadline)
         except error.ExitSelectionError as err:
             log.error("Failed to run because : %s" % err)
     return 0
 
 
+def load_module(module_name):
+    """
+    Import the given module and let it perform its one-off setup tasks.
+
+    If the module cannot be imported, None is returned.
+    """
+
+    try:
+        module = __import__("modules.%s" % module_name, fromlist=[module_name])
+    except ImportError as err:
+        log.error("Failed to load module because: %s" % err)
+        return None
+
+    if hasattr(module, "setup"):
+        log.debug("Calling module's setup() function.")
+        module.setup()
+
+    return module
+
+
+class ModuleGroup(object):
+
+    """
+    Run several modules over a single circuit per exit relay.
+
+    To the rest of exitmap, a group looks like a single module.  Its
+    destinations are the union of its modules' destinations, and its probe()
+    runs -- one after another -- the probe() of every module that the exit
+    relay's exit policy allows.
+    """
+
+    def __init__(self, modules):
+
+        self.modules = modules
+
+        # A module without destinations can be run over any exit relay, and
+        # so can the group if it contains such a module.
+
+        self.module_destinations = []
+        for module in modules:
+            if getattr(module, "destinations", None) is None:
+                self.module_destinations.append(None)
+            else:
+                self.module_destinations.append(lookup_destinations(module))
+
+        if None in self.module_destinations:
+            self.destinations = None
+        else:
+            self.destinations = set()
+            for destinations in self.module_destinations:
+                self.destinations |= destinations
+
+    def applicable(self, exit_desc, destinations):
+        """
+        Yield the modules that the given exit relay can serve, together with
+        the destinations each of them may connect to.
+        """
+
+        for module, module_dests in zip(self.modules,
+                                        self.module_destinations):
+
+            if module_dests is None:
+                applicable = destinations
+            else:
+                policy = exit_desc.exit_policy
+                applicable = frozenset(d for d in module_dests
+                                       if d in destinations and
+                                       policy.can_exit_to(*d))
+                if not applicable:
+                    continue
+
+            log.debug("Running module '%s' over exit relay %s." %
+                      (module.__name__, exit_desc.fingerprint))
+            yield module, applicable
+
+    def probe(self, exit_desc, run_python_over_tor, run_cmd_over_tor,
+              destinations, **kwargs):
+        """
+        Run the probe of every module that the given exit relay can serve.
+        """
+
+        for module, applicable in self.applicable(exit_desc, destinations):
+            try:
+                module.probe(exit_desc, run_python_over_tor, run_cmd_over_tor,
+                             destinations=applicable, **kwargs)
+            except Exception as err:
+                log.warning("Module '%s' failed over exit relay %s: %s" %
+                            (module.__name__, exit_desc.fingerprint, err))
+
+    def teardown(self):
+        """
+        Call the teardown() function of every module that has one.
+        """
+
+        for module in self.modules:
+            if hasattr(module, "teardown"):
+                module.teardown()
+
+
+class AsyncModuleGroup(ModuleGroup):
+
+    """
+    Run several asynchronous modules over a single circuit per exit relay.
+    """
+
+    async def probe(self, exit_desc, connector, destinations, **kwargs):
+        """
+        Run the probe of every module that the given exit relay can serve.
+        """
+
+        for module, applicable in self.applicable(exit_desc, destinations):
+            try:
+                await module.probe(exit_desc, connector,
+                                   destinations=applicable, **kwargs)
+            except Exception as err:
+                log.warning("Module '%s' failed over exit relay %s: %s" %
+                            (module.__name__, exit_desc.fingerprint, err))
+
+
 def lookup_destinations(module):
     """
     Determine the set of destinations that the module might like to scan.
@@ -306,6 +769,41 @@ def select_exits(args, module):
     before = datetime.datetime.now()
     destinations = lookup_destinations(module)
 
+    exit_destinations = relayselector.get_exits(args.tor_dir,
+                                                destinations=destinations,
+                                                **exit_filters(args))
+
+    log.debug("Successfully selected exit relays after %s." %
+              str(datetime.datetime.now() - before))
+
+    return exit_destinations
+
+
+def order_exits(args, exit_relays):
+    """
+    Return the given exit relays in the order that --order asks for.
+    """
+
+    bandwidths, history = None, None
+
+    if args.order == "bandwidth":
+        cached_consensus = relayselector.get_cached_consensus(
+            os.path.join(args.tor_dir, "cached-consensus"))
+        bandwidths = dict((fpr, entry.bandwidth or 0)
+                          for fpr, entry in cached_consensus.items())
+
+    elif args.order in ("last-probed", "failures"):
+        history = checkpoint.exit_history(
+            checkpoint.journal_path(args.analysis_dir))
+
+    return ordering.order_exits(exit_relays, args.order, bandwidths, history)
+
+
+def exit_filters(args):
+    """
+    Return the keyword arguments for relayselector that our options ask for.
+    """
+
     if args.exit:
         # '-e' was used to specify a single exit relay.
         requested_exits = [args.exit]
@@ -322,132 +820,464 @@ def select_exits(args, module):
     else:
         requested_exits = None
 
-    exit_destinations = relayselector.get_exits(
-        args.tor_dir,
-        good_exit       = args.all_exits or (not args.bad_exits),
-        bad_exit        = args.all_exits or args.bad_exits,
-        country_code    = args.country,
-        requested_exits = requested_exits,
-        destinations    = destinations)
+    return dict(good_exit       = args.all_exits or (not args.bad_exits),
+                bad_exit        = args.all_exits or args.bad_exits,
+                country_code    = args.country,
+                requested_exits = requested_exits)
 
-    log.debug("Successfully selected exit relays after %s." %
-              str(datetime.datetime.now() - before))
 
-    return exit_destinations
+def run_module(module_names, args, instances, stats, deadline=None):
+    """
+    Run the given exitmap modules over all available exit relays.
+
+    If more than one module is given, the modules are run as a ModuleGroup,
+    i.e., over one circuit per exit relay.  The exit relays are split across
+    the given Tor instances, and we return once all instances finished their
+    share of the scan.  If a deadline is given, the scan is paced to finish
+    by then.
+    """
 
+    module = load_modules(module_names, stats)
+    if module is None:
+        return
 
-def run_module(module_name, args, controller, socks_port, stats):
+    exit_destinations = select_exits(args, module)
+    exit_relays = order_exits(args, exit_destinations.keys())
+
+    count = len(exit_relays)
+
+    if count < 1:
+        raise error.ExitSelectionError("Exit selection yielded %d exits "
+                                       "but need at least one." % count)
+
+    scan_name = "+".join(module_names)
+    journal_path = checkpoint.journal_path(args.analysis_dir)
+
+    if args.resume:
+        finished = checkpoint.finished_exits(journal_path, scan_name)
+        exit_relays = [fpr for fpr in exit_relays if fpr not in finished]
+        log.info("Skipping %d exit relay(s) that a previous run already "
+                 "finished." % (count - len(exit_relays)))
+        if not exit_relays:
+            log.info("Nothing left to do for module(s) '%s'." % scan_name)
+            return
+
+    journal = checkpoint.Journal(journal_path, scan_name)
+    if not args.resume:
+        journal.record("start")
+
+    try:
+        scan(module, exit_relays, exit_destinations, args, instances, stats,
+             journal=journal, deadline=deadline)
+    finally:
+        journal.close()
+
+    if hasattr(module, "teardown"):
+        log.debug("Calling module's teardown() function.")
+        module.teardown()
+
+    log.info(stats)
+
+
+def run_daemon(args, instances, stats):
     """
-    Run an exitmap module over all available exit relays.
+    Keep scanning exit relays as the network changes.
+
+    Tor keeps fetching descriptors, and we follow its NEWCONSENSUS and NEWDESC
+    events to keep our view of the network up to date without parsing its
+    data directory again.  This function only returns if none of the given
+    modules could be loaded.
     """
 
-    log.info("Running module '%s'." % module_name)
-    stats.modules_run += 1
+    module = load_modules(args.module, stats)
+    if module is None:
+        return 1
 
-    try:
-        module = __import__("modules.%s" % module_name, fromlist=[module_name])
-    except ImportError as err:
-        log.error("Failed to load module because: %s" % err)
-        return
+    for instance in instances:
+        instance.controller.set_conf("FetchServerDescriptors", "1")
 
-    # Let module perform one-off setup tasks.
+    tracker = exittracker.ExitTracker(
+        relayselector.get_cached_consensus(
+            os.path.join(args.tor_dir, "cached-consensus")),
+        relayselector.get_exit_policies(
+            os.path.join(args.tor_dir, "cached-descriptors")),
+        args.rescan_interval)
 
-    if hasattr(module, "setup"):
-        log.debug("Calling module's setup() function.")
-        module.setup()
+    controller = instances[0].controller
+    updates = queue.Queue()
+    controller.add_event_listener(updates.put, EventType.NEWCONSENSUS,
+                                  EventType.NEWDESC)
+
+    destinations = lookup_destinations(module)
+    filters = exit_filters(args)
+
+    while True:
+        exit_destinations = tracker.select(destinations=destinations,
+                                           **filters)
+
+        due = tracker.due(exit_destinations.keys())
+        if due:
+            log.info("Scanning %d exit relay(s)." % len(due))
+            scan(module, due, exit_destinations, args, instances, stats)
+            tracker.scanned(due)
+            log.info(stats)
+
+        timeout = tracker.next_due(exit_destinations.keys())
+        if timeout is not None:
+            log.info("Next rescan is due in %s unless the network changes." %
+                     datetime.timedelta(seconds=int(timeout)))
+
+        try:
+            events = [updates.get(timeout=timeout)]
+        except queue.Empty:
+            continue
+
+        time.sleep(UPDATE_SETTLE_TIME)
+        while True:
+            try:
+                events.append(updates.get_nowait())
+            except queue.Empty:
+                break
+
+        apply_network_updates(tracker, controller, events)
+
+
+def apply_network_updates(tracker, controller, events):
+    """
+    Feed the given NEWCONSENSUS and NEWDESC events to the exit tracker.
+    """
+
+    for event in events:
+        if isinstance(event, stem.response.events.NewConsensusEvent):
+            log.info("Received new consensus with %d relays." %
+                     len(event.desc))
+            tracker.update_consensus(event.desc)
+
+        elif isinstance(event, stem.response.events.NewDescEvent):
+            for fpr, _ in event.relays:
+                try:
+                    desc = controller.get_server_descriptor(relay=fpr)
+                except (stem.ControllerError, ValueError) as err:
+                    log.debug("Could not fetch new descriptor of %s: %s" %
+                              (fpr, err))
+                    continue
+                tracker.update_descriptor(desc)
+
+
+def run_coordinator(args, stats):
+    """
+    Lease the selected exit relays to workers until all of them are done.
+    """
+
+    module = load_modules(args.module, stats)
+    if module is None:
+        return 1
+
+    exit_relays = order_exits(args, select_exits(args, module).keys())
+
+    host, port = args.serve_leases.rsplit(":", 1)
+    table = coordinator.LeaseTable(exit_relays, args.lease_size,
+                                   args.lease_ttl)
+    server = coordinator.CoordinatorServer(table, (host, int(port)))
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    log.info("Leasing %d exit relay(s) to workers on %s:%d." %
+             ((len(exit_relays),) + server.server_address[:2]))
+
+    while not table.finished():
+        time.sleep(1)
+
+    # Give workers a chance to learn that we are done before we go away.
+
+    time.sleep(LEASE_POLL_INTERVAL)
+    server.shutdown()
+    log.info("All %d exit relay(s) were scanned." % len(table.done))
+
+    return 0
+
+
+def run_worker(args, instances, stats):
+    """
+    Scan the exit relays that the coordinator leases to us.
+    """
+
+    module = load_modules(args.module, stats)
+    if module is None:
+        return 1
 
     exit_destinations = select_exits(args, module)
 
-    exit_relays = list(exit_destinations.keys())
-    random.shuffle(exit_relays)
+    worker = "%s-%d" % (socket.gethostname(), os.getpid())
+    client = coordinator.LeaseClient(args.coordinator, worker)
 
-    count = len(exit_relays)
-    stats.total_circuits += count
+    while True:
+        try:
+            reply = client.lease()
+        except (IOError, ValueError) as err:
+            log.warning("Could not reach coordinator: %s" % err)
+            time.sleep(LEASE_POLL_INTERVAL)
+            continue
+
+        if reply["done"]:
+            break
+
+        if reply["lease"] is None:
+            time.sleep(LEASE_POLL_INTERVAL)
+            continue
+
+        # Our consensus may differ from the coordinator's.  We report exit
+        # relays that we don't know as done rather than bouncing them back.
+
+        exit_relays = [fpr for fpr in reply["exits"]
+                       if fpr in exit_destinations]
+        if len(exit_relays) != len(reply["exits"]):
+            log.warning("Skipping %d leased exit relay(s) that we did not "
+                        "select." % (len(reply["exits"]) - len(exit_relays)))
+
+        renewer = coordinator.LeaseRenewer(client, reply["lease"],
+                                           reply["ttl"])
+        try:
+            if exit_relays:
+                scan(module, exit_relays, exit_destinations, args, instances,
+                     stats)
+        finally:
+            renewer.stop()
 
-    if count < 1:
-        raise error.ExitSelectionError("Exit selection yielded %d exits "
-                                       "but need at least one." % count)
+        try:
+            if not client.complete(reply["lease"]):
+                log.warning("Our lease expired before we completed it.")
+        except (IOError, ValueError) as err:
+            log.warning("Could not report completed lease: %s" % err)
 
-    handler = EventHandler(controller, module, socks_port, stats,
-                           exit_destinations=exit_destinations)
+    if hasattr(module, "teardown"):
+        log.debug("Calling module's teardown() function.")
+        module.teardown()
 
-    controller.add_event_listener(handler.new_event,
-                                  EventType.CIRC, EventType.STREAM)
+    log.info(stats)
 
-    duration = count * args.build_delay
-    log.info("Scan is estimated to take around %s." %
-             datetime.timedelta(seconds=duration))
+    return 0
 
-    log.info("Beginning to trigger %d circuit creation(s)." % count)
 
-    iter_exit_relays(exit_relays, controller, stats, args)
+def load_modules(module_names, stats):
+    """
+    Load the given modules and return them as a single module.
+
+    If more than one module is given, they are combined into a ModuleGroup,
+    or an AsyncModuleGroup if all of them are asynchronous.  If no module
+    could be loaded, or if asynchronous and blocking modules are mixed, None
+    is returned.
+    """
 
+    log.info("Running module(s) '%s'." % "', '".join(module_names))
 
-def sleep(delay, delay_noise):
+    modules = [load_module(module_name) for module_name in module_names]
+    modules = [module for module in modules if module is not None]
+    if not modules:
+        return None
+
+    async_modules = [module for module in modules if is_async(module)]
+    if async_modules and len(async_modules) < len(modules):
+        log.error("Cannot combine asynchronous module(s) '%s' with "
+                  "blocking modules.  Run them without --combine." %
+                  "', '".join(module.__name__ for module in async_modules))
+        return None
+
+    stats.modules_run += len(modules)
+
+    if len(modules) == 1:
+        return modules[0]
+    elif async_modules:
+        return AsyncModuleGroup(modules)
+    else:
+        return ModuleGroup(modules)
+
+
+def scan(module, exit_relays, exit_destinations, args, instances, stats,
+         journal=None, deadline=None):
     """
-    Sleep in between circuit creations.
+    Run the given module over the given exit relays and wait until it is done.
 
-    This has two purposes.  First, it spreads the load on both the Tor network
-    and our scanning destination over time.  Second, by using random values to
-    obscure our circuit creation patterns, we hopefully make it harder for a
-    vigilant adversary to detect our scanning.
+    The scan's statistics are added to `stats'.  If a journal is given, the
+    scan's progress is recorded in it.  If a deadline is given, we pace the
+    scan to finish by then and drop the exit relays at the end of the list
+    that we cannot probe in time.
     """
 
-    noise = 0
-    if delay_noise != 0:
-        noise = random.random() * delay_noise
-        if random.randint(0, 1):
-            noise = -noise
+    count = len(exit_relays)
+
+    # Unless we were given first hops, all Tor instances draw their first
+    # hops from the same pool.
+
+    first_hops = None
+    if not args.first_hop:
+        first_hops = load_first_hops(args.tor_dir)
+
+    probe_workers = max(1, args.probe_workers // len(instances))
+
+    # Every Tor instance gets its own share of exit relays, event handler,
+    # probe workers, and statistics.  Like the circuit scheduler, a first hop balancer keeps
+    # track of circuit IDs, so every instance also gets its own.
 
-    delay += noise
-    if delay < 0:
-        delay = 0
+    shards = []
+    for i, instance in enumerate(instances):
+        shard = exit_relays[i::len(instances)]
+        if not shard:
+            continue
 
-    log.debug("Sleeping for %.1fs, then building next circuit." % delay)
-    time.sleep(delay)
+        shard_stats = Statistics()
+        shard_stats.total_circuits = len(shard)
 
+        shard_first_hops = first_hops
+        if shard_first_hops is None:
+            shard_first_hops = FirstHopBalancer(args.first_hop)
 
-def iter_exit_relays(exit_relays, controller, stats, args):
+        handler = EventHandler(instance.controller, module,
+                               instance.socks_port, shard_stats,
+                               exit_destinations=exit_destinations,
+                               scheduler=instance.scheduler,
+                               first_hops=shard_first_hops,
+                               journal=journal,
+                               probe_workers=probe_workers)
+        instance.controller.add_event_listener(handler.new_event,
+                                               EventType.CIRC,
+                                               EventType.STREAM)
+        shards.append((instance, shard, handler))
+
+    log_estimate(instances[0].scheduler, len(shards[0][1]))
+
+    log.info("Beginning to trigger %d circuit creation(s) over %d Tor "
+             "instance(s)." % (count, len(shards)))
+
+    threads = []
+    for instance, shard, handler in shards:
+        thread = threading.Thread(target=iter_exit_relays,
+                                  args=(shard, handler, deadline))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    # A circuit that Tor refused to create may have been the last one we were
+    # waiting for, so we check once more after all creations were triggered.
+
+    for thread in threads:
+        thread.join()
+
+    for _, _, handler in shards:
+        handler.check_finished()
+
+    for instance, _, handler in shards:
+        handler.finished.wait()
+        instance.controller.remove_event_listener(handler.new_event)
+        handler.close()
+
+    for proc in multiprocessing.active_children():
+        log.debug("Terminating remaining PID %d." % proc.pid)
+        proc.terminate()
+
+    dropped = 0
+    for _, _, handler in shards:
+        dropped += handler.stats.dropped_exits
+        stats.merge(handler.stats)
+
+    if dropped:
+        log.warning("Dropped %d of %d exit relay(s) to finish by the "
+                    "deadline." % (dropped, count))
+
+
+def log_estimate(scheduler, count):
+    """
+    Log how long it will take to build `count' circuits at the measured rate.
+    """
+
+    duration = scheduler.estimate(count)
+    if duration is None:
+        log.info("Scan duration will be estimated once circuits were built.")
+        return
+
+    log.info("Building %d circuit(s) is estimated to take around %s at "
+             "%.2f circuits/s." % (count,
+                                   datetime.timedelta(seconds=int(duration)),
+                                   scheduler.rate()))
+
+
+def load_first_hops(tor_dir):
+    """
+    Build the pool of first hops from the consensus in Tor's data directory.
+    """
+
+    cached_consensus = relayselector.get_cached_consensus(
+        os.path.join(tor_dir, "cached-consensus"))
+    families = relayselector.get_families(
+        os.path.join(tor_dir, "cached-descriptors"))
+
+    return FirstHopPool(cached_consensus, families)
+
+
+def iter_exit_relays(exit_relays, handler, deadline=None):
     """
     Invoke circuits for all selected exit relays.
+
+    The handler's scheduler decides when the next circuit may be created, and
+    its first hops decide which first hop the circuit uses.  If a deadline is
+    given, the scheduler spreads the circuits over the time until then, and
+    we drop the exit relays that we cannot probe in time.
     """
 
+    controller = handler.controller
+    stats = handler.stats
+    scheduler = handler.scheduler
+    first_hops = handler.first_hops
+
     before = datetime.datetime.now()
-    cached_consensus_path = os.path.join(args.tor_dir, "cached-consensus")
-    fingerprints = relayselector.get_fingerprints(cached_consensus_path)
     count = len(exit_relays)
 
     # Start building a circuit for every exit relay we got.
 
     for i, exit_relay in enumerate(exit_relays):
 
-        # Determine the hops in our next circuit.
+        if deadline is not None:
+            feasible = scheduler.fit_deadline(count - i, deadline)
+            if feasible < count - i:
+                dropped = count - i - feasible
+                log.warning("Dropping the last %d exit relay(s) to finish by "
+                            "the deadline." % dropped)
+                stats.dropped_exits += dropped
+                stats.total_circuits -= dropped
+                count -= dropped
 
-        if args.first_hop:
-            hops = [args.first_hop, exit_relay]
-        else:
-            all_hops = list(fingerprints)
+        if i >= count:
+            break
 
-            try:
-                all_hops.remove(exit_relay)
-            except ValueError:
-                # Catch exception when exit is not in the cached_consensus
-                pass
-            first_hop = random.choice(all_hops)
-            log.debug("Using random first hop %s for circuit." % first_hop)
-            hops = [first_hop, exit_relay]
+        # Determine the hops in our next circuit.
 
-        assert len(hops) > 1
+        first_hop = first_hops.draw(exit_relay)
+        if first_hop is None:
+            stats.failed_circuits += 1
+            log.warning("Found no first hop for exit relay \"%s\"." %
+                        exit_relay)
+            continue
+        log.debug("Using first hop %s for circuit." % first_hop)
+        hops = [first_hop, exit_relay]
 
+        launch_time = scheduler.acquire()
         try:
-            controller.new_circuit(hops)
+            circ_id = controller.new_circuit(hops)
         except stem.ControllerError as err:
+            scheduler.launch_failed()
+            first_hops.launch_failed(first_hop)
             stats.failed_circuits += 1
             log.debug("Circuit with exit relay \"%s\" could not be "
                       "created: %s" % (exit_relay, err))
+        else:
+            handler.circuit_launched(circ_id, exit_relay)
+            scheduler.launched(circ_id, launch_time)
+            first_hops.launched(circ_id, first_hop, launch_time)
 
-        if i != (count - 1):
-            sleep(args.build_delay, args.delay_noise)
+        if (i + 1) % ESTIMATE_INTERVAL == 0:
+            log_estimate(scheduler, count - (i + 1))
 
     log.info("Done triggering circuit creations after %s." %
              str(datetime.datetime.now() - before))
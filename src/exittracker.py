@@ -0,0 +1,150 @@
+# Copyright 2013-2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Keeps track of the exit relays that a long-running exitmap has to rescan.
+"""
+
+import time
+import logging
+
+import relayselector
+
+log = logging.getLogger(__name__)
+
+
+class ExitTracker(object):
+
+    """
+    Maintain the network consensus and exit descriptors incrementally.
+
+    The tracker is fed with NEWCONSENSUS and NEWDESC updates and remembers
+    which descriptor of every exit relay we scanned last, and when.  An exit
+    relay is due for a scan if we never scanned it, if its descriptor changed
+    since we scanned it, or if we scanned it longer than `rescan_interval'
+    seconds ago.
+    """
+
+    def __init__(self, cached_consensus, have_exit_policy, rescan_interval):
+
+        # Map fingerprints to router status entries and server descriptors,
+        # just like the return values of relayselector.get_cached_consensus()
+        # and relayselector.get_exit_policies().
+
+        self.cached_consensus = cached_consensus
+        self.have_exit_policy = have_exit_policy
+        self.rescan_interval = rescan_interval
+
+        # Maps fingerprints to the (descriptor digest, timestamp) tuple of
+        # their last scan.
+
+        self.last_scanned = {}
+
+    def update_consensus(self, router_status_entries):
+        """
+        Replace our consensus with the given router status entries.
+        """
+
+        self.cached_consensus = dict((entry.fingerprint, entry)
+                                     for entry in router_status_entries)
+        log.debug("Consensus now contains %d relays." %
+                  len(self.cached_consensus))
+
+    def update_descriptor(self, desc):
+        """
+        Add or replace the server descriptor of a relay.
+        """
+
+        if desc.exit_policy.is_exiting_allowed():
+            self.have_exit_policy[desc.fingerprint] = desc
+        else:
+            self.have_exit_policy.pop(desc.fingerprint, None)
+
+    def select(self, **kwargs):
+        """
+        Select exit relays as relayselector.filter_exits() does.
+        """
+
+        return relayselector.filter_exits(self.cached_consensus,
+                                          self.have_exit_policy, **kwargs)
+
+    def _digest(self, fpr):
+        """
+        Return the digest of the given relay's current server descriptor.
+        """
+
+        desc = self.have_exit_policy.get(fpr)
+        if desc is None:
+            return None
+
+        return desc.digest()
+
+    def due(self, exit_relays, now=None):
+        """
+        Return the subset of the given exit relays that we should scan now.
+
+        New exit relays and exit relays whose descriptor changed come first,
+        followed by exit relays whose last scan is too old.
+        """
+
+        if now is None:
+            now = time.time()
+
+        changed, expired = [], []
+        for fpr in exit_relays:
+            if fpr not in self.last_scanned:
+                changed.append(fpr)
+                continue
+
+            digest, timestamp = self.last_scanned[fpr]
+            if digest != self._digest(fpr):
+                changed.append(fpr)
+            elif now - timestamp >= self.rescan_interval:
+                expired.append(fpr)
+
+        log.debug("%d exit relays are new or changed and %d are due for a "
+                  "rescan." % (len(changed), len(expired)))
+
+        return changed + expired
+
+    def next_due(self, exit_relays, now=None):
+        """
+        Return the number of seconds until the next scheduled rescan.
+
+        Returns None if none of the given exit relays was scanned yet.
+        """
+
+        if now is None:
+            now = time.time()
+
+        timestamps = [self.last_scanned[fpr][1] for fpr in exit_relays
+                      if fpr in self.last_scanned]
+        if not timestamps:
+            return None
+
+        return max(0, min(timestamps) + self.rescan_interval - now)
+
+    def scanned(self, exit_relays, now=None):
+        """
+        Remember that we just scanned the given exit relays.
+        """
+
+        if now is None:
+            now = time.time()
+
+        for fpr in exit_relays:
+            self.last_scanned[fpr] = (self._digest(fpr), now)
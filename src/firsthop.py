@@ -0,0 +1,405 @@
+# Copyright 2013-2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Picks the first hop of our circuits.
+
+If the user gave us no first hops, we only consider relays that Tor itself
+would use as entry guards, i.e., relays with the Guard, Fast, and Stable
+flag, and we weigh them by their consensus bandwidth.  The pool is built once
+per scan and draws a first hop in constant expected time.
+
+If the user gave us first hops, we spread our circuits over them, preferring
+first hops with few circuits under construction and a low build latency.
+
+Both classes are told about the outcome of every circuit, just like the
+circuit scheduler.
+"""
+
+import time
+import random
+import logging
+import threading
+import collections
+
+import stem
+
+log = logging.getLogger(__name__)
+
+# Flags that a relay needs to be considered as first hop.
+
+FIRST_HOP_FLAGS = frozenset([stem.Flag.GUARD, stem.Flag.FAST,
+                             stem.Flag.STABLE])
+
+# Number of weighted draws before we give up rejection sampling and scan the
+# pool for a suitable first hop.
+
+MAX_ATTEMPTS = 64
+
+# Number of recent circuit outcomes per first hop that we compute its failure
+# ratio over, and the number of outcomes we need before we trust it.
+
+HISTORY_SIZE = 16
+MIN_HISTORY = 8
+
+# If more than this fraction of a first hop's recent circuits failed, we stop
+# using it for DROP_TIME seconds.
+
+FAILURE_THRESHOLD = 0.5
+DROP_TIME = 60
+
+# Weight of a new sample in the moving average of a first hop's build latency.
+
+LATENCY_ALPHA = 0.125
+
+
+def subnet(address):
+    """
+    Return the /16 network of the given IPv4 address, e.g., "1.2" for
+    "1.2.3.4".
+    """
+
+    return ".".join(address.split(".")[:2])
+
+
+def parse_family(family):
+    """
+    Return the set of fingerprints in the given descriptor family.
+
+    Family members are given as "$FINGERPRINT", optionally followed by "~" or
+    "=" and a nickname, or as bare nicknames, which we ignore.
+    """
+
+    fingerprints = set()
+
+    for member in family:
+        if not member.startswith("$"):
+            continue
+        fingerprints.add(member[1:41].upper())
+
+    return fingerprints
+
+
+class AliasTable(object):
+
+    """
+    Draw items with probability proportional to their weight in O(1).
+
+    This is Vose's alias method.  If all weights are zero, items are drawn
+    uniformly.
+    """
+
+    def __init__(self, items, weights):
+
+        if not items:
+            raise ValueError("Cannot build alias table without items.")
+
+        self.items = list(items)
+        count = len(self.items)
+        total = float(sum(weights))
+
+        if total <= 0:
+            scaled = [1.0] * count
+        else:
+            scaled = [weight * count / total for weight in weights]
+
+        self.prob = [1.0] * count
+        self.alias = list(range(count))
+
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] += scaled[less] - 1
+            if scaled[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+
+        # Whatever is left over is due to rounding errors and has a
+        # probability of (almost exactly) 1.
+
+    def draw(self):
+        """
+        Return a randomly drawn item.
+        """
+
+        i = random.randrange(len(self.items))
+        if random.random() < self.prob[i]:
+            return self.items[i]
+
+        return self.items[self.alias[i]]
+
+
+class FirstHopPool(object):
+
+    """
+    A bandwidth-weighted pool of first hops, built once from the consensus.
+
+    `cached_consensus' maps fingerprints to router status entries and
+    `families' optionally maps fingerprints to sets of fingerprints that the
+    relay declared to be in its family.
+    """
+
+    def __init__(self, cached_consensus, families=None):
+
+        self.families = families or {}
+
+        # We need the /16 of every relay, including exits, to keep the first
+        # hop and the exit relay in different networks.
+
+        self.subnets = dict((fpr, subnet(desc.address))
+                            for fpr, desc in cached_consensus.items())
+
+        candidates = [desc for desc in cached_consensus.values()
+                      if FIRST_HOP_FLAGS.issubset(desc.flags)]
+        if not candidates:
+            log.warning("No relay in the consensus has the Guard, Fast, and "
+                        "Stable flag.  Drawing first hops from all relays.")
+            candidates = list(cached_consensus.values())
+
+        self.fingerprints = [desc.fingerprint for desc in candidates]
+        self.table = AliasTable(self.fingerprints,
+                                [desc.bandwidth or 0 for desc in candidates])
+
+        log.info("Drawing first hops from %d relays." % len(candidates))
+
+    def __len__(self):
+
+        return len(self.fingerprints)
+
+    def compatible(self, first_hop, exit_relay):
+        """
+        Return True if Tor will build a circuit from the given first hop to
+        the given exit relay.
+        """
+
+        if first_hop == exit_relay:
+            return False
+
+        exit_subnet = self.subnets.get(exit_relay)
+        if exit_subnet is not None and \
+           self.subnets.get(first_hop) == exit_subnet:
+            return False
+
+        # We are more strict than Tor, which only considers relays family if
+        # both declare each other.
+
+        if exit_relay in self.families.get(first_hop, ()) or \
+           first_hop in self.families.get(exit_relay, ()):
+            return False
+
+        return True
+
+    def draw(self, exit_relay):
+        """
+        Return a first hop for the given exit relay, or None if there is none.
+        """
+
+        for _ in range(MAX_ATTEMPTS):
+            first_hop = self.table.draw()
+            if self.compatible(first_hop, exit_relay):
+                return first_hop
+
+        # We only get here if (almost) the whole pool is incompatible with the
+        # exit relay, so we can afford a linear scan.
+
+        candidates = [fpr for fpr in self.fingerprints
+                      if self.compatible(fpr, exit_relay)]
+        if not candidates:
+            return None
+
+        return random.choice(candidates)
+
+    def launched(self, circ_id, first_hop, launch_time):
+        """
+        The pool does not adapt to circuit outcomes.
+        """
+
+    def launch_failed(self, first_hop):
+        """
+        The pool does not adapt to circuit outcomes.
+        """
+
+    def circuit_built(self, circ_id):
+        """
+        The pool does not adapt to circuit outcomes.
+        """
+
+    def circuit_failed(self, circ_id):
+        """
+        The pool does not adapt to circuit outcomes.
+        """
+
+
+class FirstHop(object):
+
+    """
+    What we know about one of the user's first hops.
+    """
+
+    def __init__(self, fingerprint):
+
+        self.fingerprint = fingerprint
+        self.outstanding = 0
+        self.latency = None
+        self.history = collections.deque(maxlen=HISTORY_SIZE)
+        self.dropped_until = 0
+
+    def cost(self):
+        """
+        Return the expected time until a new circuit over us is built.
+
+        First hops whose latency we have not measured yet are preferred, so
+        that we measure all of them.
+        """
+
+        if self.latency is None:
+            return (0, self.outstanding)
+
+        return ((self.outstanding + 1) * self.latency, self.outstanding)
+
+    def failure_ratio(self):
+        """
+        Return the fraction of our recent circuits that failed.
+        """
+
+        if len(self.history) < MIN_HISTORY:
+            return 0.0
+
+        return self.history.count(False) / float(len(self.history))
+
+
+class FirstHopBalancer(object):
+
+    """
+    Spread circuits over the user's first hops.
+
+    Every circuit goes to the first hop with the lowest expected build time,
+    which is based on the number of its circuits under construction and its
+    measured build latency.  First hops whose circuits suddenly fail are
+    dropped for a while.  If all first hops are dropped, we use them anyway.
+    """
+
+    def __init__(self, fingerprints):
+
+        if not fingerprints:
+            raise ValueError("Cannot balance over zero first hops.")
+
+        self.first_hops = [FirstHop(fpr) for fpr in fingerprints]
+        self.index = dict((hop.fingerprint, hop) for hop in self.first_hops)
+        self.lock = threading.Lock()
+
+        # Maps circuit IDs to (first hop, launch time) tuples.
+
+        self.circuits = {}
+
+        # Circuit events which arrived before we learned the circuit's ID.
+
+        self.early = {}
+
+    def __len__(self):
+
+        return len(self.first_hops)
+
+    def draw(self, exit_relay, now=None):
+        """
+        Return a first hop for the given exit relay, or None if there is none.
+        """
+
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            candidates = [hop for hop in self.first_hops
+                          if hop.fingerprint != exit_relay]
+            if not candidates:
+                return None
+
+            available = [hop for hop in candidates if hop.dropped_until <= now]
+            hop = min(available or candidates, key=FirstHop.cost)
+            hop.outstanding += 1
+
+            return hop.fingerprint
+
+    def launched(self, circ_id, first_hop, launch_time):
+        """
+        Remember which first hop the given circuit uses.
+        """
+
+        with self.lock:
+            self.circuits[circ_id] = (self.index[first_hop], launch_time)
+
+            if circ_id in self.early:
+                built, when = self.early.pop(circ_id)
+                self._outcome(circ_id, built, when)
+
+    def launch_failed(self, first_hop):
+        """
+        Release a circuit that Tor refused to create.
+        """
+
+        with self.lock:
+            self.index[first_hop].outstanding -= 1
+
+    def circuit_built(self, circ_id):
+        """
+        Account for a circuit that was successfully built.
+        """
+
+        with self.lock:
+            self._outcome(circ_id, True, time.time())
+
+    def circuit_failed(self, circ_id):
+        """
+        Account for a circuit that failed to build.
+        """
+
+        with self.lock:
+            self._outcome(circ_id, False, time.time())
+
+    def _outcome(self, circ_id, built, when):
+        """
+        Update the first hop of the given circuit.
+
+        Must be called with the lock held.
+        """
+
+        if circ_id not in self.circuits:
+            self.early[circ_id] = (built, when)
+            return
+
+        hop, launch_time = self.circuits.pop(circ_id)
+        hop.outstanding -= 1
+        hop.history.append(built)
+
+        if built:
+            latency = when - launch_time
+            if hop.latency is None:
+                hop.latency = latency
+            else:
+                hop.latency += LATENCY_ALPHA * (latency - hop.latency)
+        elif hop.failure_ratio() > FAILURE_THRESHOLD:
+            log.warning("%d of the last %d circuits over first hop %s "
+                        "failed.  Not using it for %d seconds." %
+                        (hop.history.count(False), len(hop.history),
+                         hop.fingerprint, DROP_TIME))
+            hop.dropped_until = when + DROP_TIME
+            hop.history.clear()
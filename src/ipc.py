@@ -0,0 +1,116 @@
+# Copyright 2013-2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Carries messages from probes to the event handler.
+
+Probes send two kinds of messages: (circuit ID, socket name) when they opened
+a connection to Tor's SOCKS port whose stream must be attached to the circuit,
+and (circuit ID, None) when they are done.  Both are packed into fixed-size
+records and sent over a Unix datagram socket pair, which forked probe
+workers inherit.  Datagrams are never split or interleaved, so any number of
+processes and threads can write at the same time.
+"""
+
+import socket
+import struct
+import logging
+
+log = logging.getLogger(__name__)
+
+# A record consists of its type, the circuit ID, and the IPv4 address and
+# port of the probe's connection to Tor's SOCKS port.
+
+RECORD = struct.Struct("!BI4sH")
+
+STREAM = 0
+DONE = 1
+CLOSE = 2
+
+_NO_ADDRESS = b"\x00" * 4
+
+
+class Channel(object):
+
+    """
+    A queue-like channel from probes to the event handler.
+
+    put() and get() take and return the same (circuit ID, socket name) tuples
+    that the event handler always read from its queue.  Circuit IDs must be
+    numeric and socket names must be IPv4 (address, port) tuples.
+    """
+
+    def __init__(self):
+
+        self.reader, self.writer = socket.socketpair(socket.AF_UNIX,
+                                                     socket.SOCK_DGRAM)
+
+    def put(self, message):
+        """
+        Send the given (circuit ID, socket name) message.
+        """
+
+        circ_id, sockname = message
+
+        if sockname is None:
+            record = RECORD.pack(DONE, int(circ_id), _NO_ADDRESS, 0)
+        else:
+            address, port = sockname[:2]
+            record = RECORD.pack(STREAM, int(circ_id),
+                                 socket.inet_aton(address), port)
+
+        self.writer.send(record)
+
+    def get(self):
+        """
+        Block until a message arrives and return it.
+
+        Raises EOFError once the channel was closed.
+        """
+
+        record = self.reader.recv(RECORD.size)
+        if len(record) != RECORD.size:
+            raise EOFError("Truncated IPC record.")
+
+        kind, circ_id, address, port = RECORD.unpack(record)
+        if kind == CLOSE:
+            raise EOFError("IPC channel closed.")
+        elif kind == DONE:
+            return str(circ_id), None
+        else:
+            return str(circ_id), (socket.inet_ntoa(address), port)
+
+    def close(self):
+        """
+        Wake up the reader with an EOFError and close the writing end.
+
+        Probe workers that inherited the channel keep their copy of the
+        writing end open until they exit.
+        """
+
+        try:
+            self.writer.send(RECORD.pack(CLOSE, 0, _NO_ADDRESS, 0))
+        except OSError as err:
+            log.debug("Could not close IPC channel: %s" % err)
+        self.writer.close()
+
+    def close_reader(self):
+        """
+        Close the reading end, once nobody reads from it anymore.
+        """
+
+        self.reader.close()
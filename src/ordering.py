@@ -0,0 +1,81 @@
+# Copyright 2013-2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Decides in which order exit relays are scanned.
+"""
+
+import random
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def by_bandwidth(exit_relays, bandwidths, history):
+    """
+    Scan exit relays with a high consensus weight first.
+    """
+
+    return sorted(exit_relays, key=lambda fpr: bandwidths.get(fpr, 0),
+                  reverse=True)
+
+
+def by_last_probed(exit_relays, bandwidths, history):
+    """
+    Scan exit relays that we never probed, or probed longest ago, first.
+    """
+
+    return sorted(exit_relays,
+                  key=lambda fpr: history.get(fpr, (0, 0))[0])
+
+
+def by_failures(exit_relays, bandwidths, history):
+    """
+    Scan exit relays whose circuits failed least often in the past first.
+    """
+
+    return sorted(exit_relays,
+                  key=lambda fpr: history.get(fpr, (0, 0))[1])
+
+
+# Maps the names of ordering policies to functions that take a list of exit
+# relay fingerprints, a dictionary mapping fingerprints to consensus weights,
+# and a dictionary mapping fingerprints to (time of last probe, number of
+# failed circuits) tuples, and return the ordered list.
+
+POLICIES = {
+    "random": lambda exit_relays, bandwidths, history: exit_relays,
+    "bandwidth": by_bandwidth,
+    "last-probed": by_last_probed,
+    "failures": by_failures,
+}
+
+
+def order_exits(exit_relays, policy, bandwidths=None, history=None):
+    """
+    Return the given exit relays in the order that the given policy dictates.
+
+    Exit relays that the policy considers equal remain in random order.
+    """
+
+    exit_relays = list(exit_relays)
+    random.shuffle(exit_relays)
+
+    log.debug("Ordering %d exit relays by policy \"%s\"." %
+              (len(exit_relays), policy))
+
+    return POLICIES[policy](exit_relays, bandwidths or {}, history or {})
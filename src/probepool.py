@@ -0,0 +1,297 @@
+# Copyright 2013-2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Runs probes in a fixed number of pre-forked worker processes.
+
+The workers are forked after the module's setup() function ran, so they
+inherit whatever state it prepared and never import the module again.  Every
+worker has its own pipe over which it receives one job at a time, so we
+always know which worker runs which circuit's probe.  Jobs that arrive while
+all workers are busy wait in the pool until a worker is done.
+
+Modules whose probe() is a coroutine don't need processes at all.  Their
+probes run concurrently in a single event loop in a thread of exitmap's
+process.
+"""
+
+import asyncio
+import logging
+import threading
+import collections
+import multiprocessing
+
+import command
+import torsocks
+
+log = logging.getLogger(__name__)
+
+# Workers rely on inheriting the module and the IPC queue, so we always fork.
+
+_context = multiprocessing.get_context("fork")
+
+
+def worker_main(module, conn, queue, socks_port, report_streams):
+    """
+    Run probes until the pool closes our pipe.
+
+    Every job is a (circuit ID, exit descriptor, destinations) tuple.  Once a
+    probe is done -- whether it succeeded or not -- we tell the event handler
+    over the IPC queue.  The probe only reports its connections to Tor's SOCKS
+    port over the queue if `report_streams' is True.
+    """
+
+    stream_queue = queue if report_streams else None
+
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            break
+        if job is None:
+            break
+
+        circ_id, exit_desc, destinations = job
+
+        try:
+            module.probe(exit_desc,
+                         command.run_python_over_tor(stream_queue, circ_id,
+                                                     socks_port),
+                         command.Command(stream_queue, circ_id, socks_port),
+                         destinations=destinations)
+        except KeyboardInterrupt:
+            break
+        except Exception as err:
+            log.warning("Probe of exit relay %s failed: %s" %
+                        (exit_desc.fingerprint, err))
+
+        log.debug("Informing event handler that module finished.")
+        queue.put((circ_id, None))
+
+
+class ProbeWorker(object):
+
+    """
+    A worker process together with the pipe we send it jobs over.
+    """
+
+    def __init__(self, module, queue, socks_port, report_streams):
+
+        reader, self.conn = _context.Pipe(duplex=False)
+        self.process = _context.Process(target=worker_main,
+                                        args=(module, reader, queue,
+                                              socks_port, report_streams))
+        self.process.daemon = True
+        self.process.start()
+        reader.close()
+
+    def send(self, job):
+        """
+        Hand the given job to the worker.
+        """
+
+        self.conn.send(job)
+
+
+class ProbePool(object):
+
+    """
+    Dispatch probes to a fixed number of worker processes.
+
+    The event handler submits a job for every built circuit and calls done()
+    when it learns over the IPC queue that the circuit's probe finished.  If
+    the event handler attaches streams by their SOCKS user name, it sets
+    `report_streams' to False.
+    """
+
+    def __init__(self, module, queue, socks_port, size, report_streams=True):
+
+        self.lock = threading.Lock()
+        self.workers = [ProbeWorker(module, queue, socks_port, report_streams)
+                        for _ in range(max(1, size))]
+        self.idle = list(self.workers)
+        self.pending = collections.deque()
+
+        # Maps circuit IDs to the worker that runs their probe.
+
+        self.assignments = {}
+
+        log.debug("Started %d probe worker(s)." % len(self.workers))
+
+    def submit(self, circ_id, exit_desc, destinations):
+        """
+        Run a probe over the given circuit as soon as a worker is idle.
+        """
+
+        with self.lock:
+            self.pending.append((circ_id, exit_desc, destinations))
+            self._dispatch()
+
+    def done(self, circ_id):
+        """
+        Mark the worker that probed over the given circuit as idle again.
+        """
+
+        with self.lock:
+            worker = self.assignments.pop(circ_id, None)
+            if worker is not None:
+                self.idle.append(worker)
+            self._dispatch()
+
+    def busy(self):
+        """
+        Return the number of probes that are running or waiting for a worker.
+        """
+
+        with self.lock:
+            return len(self.assignments) + len(self.pending)
+
+    def _dispatch(self):
+        """
+        Hand pending jobs to idle workers.
+
+        Must be called with the lock held.
+        """
+
+        while self.pending and self.idle:
+            job = self.pending.popleft()
+            worker = self.idle.pop()
+            self.assignments[job[0]] = worker
+            worker.send(job)
+
+    def close(self, timeout=5):
+        """
+        Stop all workers, and terminate those that do not stop in time.
+        """
+
+        with self.lock:
+            self.pending.clear()
+            for worker in self.workers:
+                try:
+                    worker.send(None)
+                except (IOError, OSError):
+                    pass
+
+        for worker in self.workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                log.debug("Terminating probe worker %d." %
+                          worker.process.pid)
+                worker.process.terminate()
+            worker.conn.close()
+
+
+def is_async(module):
+    """
+    Return True if the given module's probe() is a coroutine function.
+    """
+
+    return asyncio.iscoroutinefunction(module.probe)
+
+
+class ProbeLoop(object):
+
+    """
+    Run the probes of an asynchronous module in an event loop.
+
+    The loop runs in its own thread and offers the same interface as
+    ProbePool.  Probes talk to Tor's SOCKS port directly, and report their
+    connections and their end over the IPC queue, just like probe processes.
+    """
+
+    def __init__(self, module, queue, socks_port, report_streams=True):
+
+        self.module = module
+        self.queue = queue
+        self.socks_port = socks_port
+        self.report_streams = report_streams
+        self.lock = threading.Lock()
+
+        # Maps circuit IDs to the future of their probe.
+
+        self.futures = {}
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    async def run(self, circ_id, exit_desc, destinations):
+        """
+        Run the module's probe over the given circuit.
+        """
+
+        def on_connect(sockname):
+            self.queue.put((circ_id, sockname))
+
+        connector = torsocks.TorConnector(
+            self.socks_port, circ_id,
+            on_connect if self.report_streams else None)
+
+        try:
+            await self.module.probe(exit_desc, connector,
+                                    destinations=destinations)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            log.warning("Probe of exit relay %s failed: %s" %
+                        (exit_desc.fingerprint, err))
+
+        log.debug("Informing event handler that module finished.")
+        self.queue.put((circ_id, None))
+
+    def submit(self, circ_id, exit_desc, destinations):
+        """
+        Start a probe over the given circuit.
+        """
+
+        future = asyncio.run_coroutine_threadsafe(
+            self.run(circ_id, exit_desc, destinations), self.loop)
+
+        with self.lock:
+            self.futures[circ_id] = future
+
+    def done(self, circ_id):
+        """
+        Forget the probe over the given circuit.
+        """
+
+        with self.lock:
+            self.futures.pop(circ_id, None)
+
+    def busy(self):
+        """
+        Return the number of running probes.
+        """
+
+        with self.lock:
+            return len(self.futures)
+
+    def close(self, timeout=5):
+        """
+        Cancel all running probes and stop the event loop.
+        """
+
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+            self.futures.clear()
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+        if not self.thread.is_alive():
+            self.loop.close()
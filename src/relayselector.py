@@ -30,6 +30,7 @@ import stem
 import stem.descriptor
 
 import util
+import firsthop
 
 log = logging.getLogger(__name__)
 
@@ -67,6 +68,25 @@ def parse_cmd_args():
     return parser.parse_args()
 
 
+class UniversalSet(object):
+    """A universal set contains everything, but cannot be enumerated.
+
+    If the caller of get_exits does not specify destinations,
+    its return value maps all fingerprints to a universal set,
+    so that it can still fulfill the contract of returning a
+    dictionary of the form { fingerprint : set(...) }.
+
+    The class lives at module level, so that it can be pickled and
+    sent to probe workers.
+    """
+    def __nonzero__(self): return True
+
+    def __contains__(self, obj): return True
+
+    # __len__ is obliged to return a positive integer.
+    def __len__(self): return sys.maxsize
+
+
 def get_fingerprints(cached_consensus_path, exclude=[]):
     """
     Get all relay fingerprints in the provided consensus.
@@ -104,6 +124,26 @@ def get_exit_policies(cached_descriptors_path):
         sys.exit(1)
 
 
+def get_families(cached_descriptors_path):
+    """Read all relays' declared families from "cached_descriptors".
+
+    Returns a dictionary mapping fingerprints to sets of fingerprints."""
+
+    families = {}
+
+    try:
+        for desc in stem.descriptor.parse_file(cached_descriptors_path,
+                                               validate=False):
+            if desc.family:
+                families[desc.fingerprint] = firsthop.parse_family(
+                    desc.family)
+    except IOError as err:
+        log.warning("File \"%s\" could not be read: %s" %
+                    (cached_descriptors_path, err))
+
+    return families
+
+
 def get_cached_consensus(cached_consensus_path):
     """Read relays' summarized descriptors from "cached_consensus"."""
     try:
@@ -162,13 +202,33 @@ def get_exits(data_dir,
     returns True.)
     """
 
-
     cached_consensus_path = os.path.join(data_dir, "cached-consensus")
     cached_descriptors_path = os.path.join(data_dir, "cached-descriptors")
 
     cached_consensus = get_cached_consensus(cached_consensus_path)
     have_exit_policy = get_exit_policies(cached_descriptors_path)
 
+    return filter_exits(cached_consensus, have_exit_policy,
+                        good_exit=good_exit, bad_exit=bad_exit,
+                        version=version, nickname=nickname, address=address,
+                        country_code=country_code,
+                        requested_exits=requested_exits,
+                        destinations=destinations)
+
+
+def filter_exits(cached_consensus, have_exit_policy,
+                 good_exit=True, bad_exit=False,
+                 version=None, nickname=None, address=None, country_code=None,
+                 requested_exits=None, destinations=None):
+    """Extract all exit relays that have the desired set of attributes.
+
+    This does the work of get_exits() on an already parsed consensus, which
+    maps fingerprints to router status entries, and already parsed server
+    descriptors, which map fingerprints of relays that allow exiting to their
+    descriptors.  Callers that keep both up to date can thus reselect exits
+    without reading Tor's data directory again.
+    """
+
     # Drop all exit relays which have a descriptor, but either did not
     # make it into the consensus at all, or are not marked as exits there.
     class StubDesc(object):
@@ -244,20 +304,6 @@ def get_exits(data_dir,
         return {}
 
     if not destinations:
-        class UniversalSet(object):
-            """A universal set contains everything, but cannot be enumerated.
-
-            If the caller of get_exits does not specify destinations,
-            its return value maps all fingerprints to a universal set,
-            so that it can still fulfill the contract of returning a
-            dictionary of the form { fingerprint : set(...) }.
-            """
-            def __nonzero__(self): return True
-
-            def __contains__(self, obj): return True
-
-            # __len__ is obliged to return a positive integer.
-            def __len__(self): return sys.maxsize
         us = UniversalSet()
         exit_destinations = {
             desc.fingerprint: us for desc in exit_candidates}
@@ -0,0 +1,356 @@
+# Copyright 2013-2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Decides when the next circuit may be created.
+"""
+
+import time
+import random
+import logging
+import threading
+import collections
+
+log = logging.getLogger(__name__)
+
+# The window grows by 1/window for every circuit that builds without any sign
+# of congestion, and it shrinks by this factor when we see congestion.
+
+DECREASE_FACTOR = 0.5
+
+# We consider the network congested if more than this fraction of our recent
+# circuits failed...
+
+FAILURE_THRESHOLD = 0.25
+
+# ...or if the smoothed build latency exceeds the lowest smoothed build latency
+# we have seen by this factor, and by at least this many seconds, so that
+# jitter in very short build latencies does not count as congestion.
+
+LATENCY_FACTOR = 2.0
+MIN_LATENCY_INCREASE = 0.5
+
+# Number of recent circuit outcomes that the failure ratio is computed over.
+
+HISTORY_SIZE = 32
+
+# Weight of a new sample in the exponentially weighted moving average of the
+# circuit build latency.
+
+LATENCY_ALPHA = 0.125
+
+# Number of latency samples we need before we trust the moving average.
+
+MIN_LATENCY_SAMPLES = 8
+
+# When scanning against a deadline, we plan to finish after this fraction of
+# the remaining time, to leave room for estimation errors.
+
+DEADLINE_SLACK = 0.9
+
+
+def noisy_delay(delay, delay_noise):
+    """
+    Return the given delay, randomly perturbed by up to `delay_noise' seconds.
+
+    This has two purposes.  First, it spreads the load on both the Tor network
+    and our scanning destination over time.  Second, by using random values to
+    obscure our circuit creation patterns, we hopefully make it harder for a
+    vigilant adversary to detect our scanning.
+    """
+
+    noise = 0
+    if delay_noise != 0:
+        noise = random.random() * delay_noise
+        if random.randint(0, 1):
+            noise = -noise
+
+    return max(0, delay + noise)
+
+
+class CircuitScheduler(object):
+
+    """
+    Keep an adaptive, bounded number of circuits under construction.
+
+    The number of circuits that may be under construction at the same time --
+    the window -- is adjusted using additive increase, multiplicative
+    decrease.  Independent of the window, two circuit creations are always at
+    least `build_delay' seconds apart, which caps the rate at which we create
+    circuits.
+
+    The event handler reports the outcome of every circuit we launched by
+    calling circuit_built() and circuit_failed(), and the end of every probe
+    by calling probe_finished().
+    """
+
+    def __init__(self, build_delay, delay_noise=0, initial_window=4,
+                 max_window=32):
+
+        self.min_delay = build_delay
+        self.build_delay = build_delay
+        self.delay_noise = delay_noise
+        self.max_window = max(1, max_window)
+        self.window = float(min(max(1, initial_window), self.max_window))
+
+        self.cond = threading.Condition()
+
+        # Maps circuit IDs to the time they were launched at.
+
+        self.launch_times = {}
+
+        # Circuit events which arrived before we learned the circuit's ID.
+
+        self.early = {}
+
+        self.in_flight = 0
+        self.next_launch = 0
+        self.history = collections.deque(maxlen=HISTORY_SIZE)
+        self.cooldown = 0
+
+        self.latency = None
+        self.base_latency = None
+        self.latency_samples = 0
+
+        # Maps circuit IDs of built circuits to the time their probe started.
+
+        self.probe_starts = {}
+        self.probe_time = None
+
+        self.first_launch = None
+        self.built = 0
+        self.failed = 0
+
+    def acquire(self):
+        """
+        Block until we may create another circuit and return the current time.
+
+        The caller must subsequently call either launched() or launch_failed().
+        """
+
+        with self.cond:
+            while True:
+                now = time.time()
+                if self.in_flight >= int(self.window):
+                    self.cond.wait()
+                elif now < self.next_launch:
+                    self.cond.wait(self.next_launch - now)
+                else:
+                    break
+
+            self.in_flight += 1
+            self.next_launch = now + noisy_delay(self.build_delay,
+                                                 self.delay_noise)
+            if self.first_launch is None:
+                self.first_launch = now
+
+            log.debug("Launching circuit with %d/%d circuit(s) in flight." %
+                      (self.in_flight, int(self.window)))
+
+            return now
+
+    def launched(self, circ_id, launch_time):
+        """
+        Remember when the circuit with the given ID was launched.
+        """
+
+        with self.cond:
+            self.launch_times[circ_id] = launch_time
+
+            if circ_id in self.early:
+                built, when = self.early.pop(circ_id)
+                self._outcome(circ_id, built, when)
+
+    def launch_failed(self):
+        """
+        Release the slot of a circuit that Tor refused to create.
+        """
+
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def circuit_built(self, circ_id):
+        """
+        Account for a circuit that was successfully built.
+        """
+
+        with self.cond:
+            self._outcome(circ_id, True, time.time())
+
+    def circuit_failed(self, circ_id):
+        """
+        Account for a circuit that failed to build.
+        """
+
+        with self.cond:
+            self._outcome(circ_id, False, time.time())
+
+    def _outcome(self, circ_id, built, when):
+        """
+        Adjust the window to the given circuit outcome.
+
+        Must be called with the condition variable held.
+        """
+
+        if circ_id not in self.launch_times:
+            self.early[circ_id] = (built, when)
+            return
+
+        latency = when - self.launch_times.pop(circ_id)
+        self.in_flight -= 1
+        self.history.append(built)
+
+        if built:
+            self.built += 1
+            self.probe_starts[circ_id] = when
+            self._update_latency(latency)
+        else:
+            self.failed += 1
+
+        # After decreasing the window, we ignore the outcome of the circuits
+        # that were already in flight because they predate the decrease.
+
+        if self.cooldown > 0:
+            self.cooldown -= 1
+        elif self.congested():
+            self.window = max(1.0, self.window * DECREASE_FACTOR)
+            self.cooldown = self.in_flight
+            log.debug("Decreasing circuit window to %.2f." % self.window)
+        elif built:
+            self.window = min(self.max_window, self.window + 1 / self.window)
+
+        self.cond.notify_all()
+
+    def _update_latency(self, latency):
+        """
+        Fold the given build latency into our moving average.
+        """
+
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_ALPHA * (latency - self.latency)
+
+        self.latency_samples += 1
+        if self.latency_samples >= MIN_LATENCY_SAMPLES:
+            if self.base_latency is None or self.latency < self.base_latency:
+                self.base_latency = self.latency
+
+    def probe_finished(self, circ_id):
+        """
+        Fold the run time of the given circuit's probe into our moving average.
+        """
+
+        with self.cond:
+            start = self.probe_starts.pop(circ_id, None)
+            if start is None:
+                return
+
+            duration = time.time() - start
+            if self.probe_time is None:
+                self.probe_time = duration
+            else:
+                self.probe_time += LATENCY_ALPHA * (duration - self.probe_time)
+
+    def fit_deadline(self, remaining, deadline, now=None):
+        """
+        Spread the remaining circuit creations over the time until `deadline'.
+
+        We never create circuits faster than the build delay we were
+        configured with or than our maximum window allows.  Returns how many
+        of the `remaining' circuits we can create in time, given the measured
+        build latency and probe time.
+        """
+
+        if now is None:
+            now = time.time()
+
+        with self.cond:
+            tail = (self.latency or 0) + (self.probe_time or 0)
+            budget = (deadline - now - tail) * DEADLINE_SLACK
+            if budget <= 0:
+                return 0
+
+            feasible = remaining
+            if self.min_delay > 0:
+                feasible = min(feasible, int(budget / self.min_delay))
+            if self.latency:
+                feasible = min(feasible,
+                               int(budget * self.max_window / self.latency))
+
+            if feasible > 0:
+                self.build_delay = max(self.min_delay, budget / feasible)
+            else:
+                self.build_delay = self.min_delay
+            self.cond.notify_all()
+
+            return feasible
+
+    def failure_ratio(self):
+        """
+        Return the fraction of recent circuits that failed.
+        """
+
+        if not self.history:
+            return 0.0
+
+        return self.history.count(False) / float(len(self.history))
+
+    def congested(self):
+        """
+        Return True if recent circuit outcomes suggest congestion.
+        """
+
+        if self.failure_ratio() > FAILURE_THRESHOLD:
+            return True
+
+        if self.base_latency is not None and \
+           self.latency > LATENCY_FACTOR * self.base_latency and \
+           self.latency - self.base_latency > MIN_LATENCY_INCREASE:
+            return True
+
+        return False
+
+    def rate(self):
+        """
+        Return the measured number of finished circuit builds per second.
+
+        If we have not measured anything yet, None is returned.
+        """
+
+        finished = self.built + self.failed
+        if self.first_launch is None or finished == 0:
+            return None
+
+        elapsed = time.time() - self.first_launch
+        if elapsed <= 0:
+            return None
+
+        return finished / elapsed
+
+    def estimate(self, count):
+        """
+        Return the estimated number of seconds it takes to build `count'
+        circuits, or None if we have no measurements yet.
+        """
+
+        rate = self.rate()
+        if rate is None:
+            return None
+
+        return count / rate
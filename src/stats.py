@@ -45,6 +45,7 @@ class Statistics(object):
         self.modules_run = 0
         self.finished_streams = 0
         self.failed_streams = 0
+        self.dropped_exits = 0
 
     def update_circs(self, circ_event):
         """
@@ -60,6 +61,18 @@ class Statistics(object):
 
             self.successful_circuits += 1
 
+    def merge(self, other):
+        """
+        Add the circuit and stream counters of another Statistics object.
+        """
+
+        self.total_circuits += other.total_circuits
+        self.failed_circuits += other.failed_circuits
+        self.successful_circuits += other.successful_circuits
+        self.finished_streams += other.finished_streams
+        self.failed_streams += other.failed_streams
+        self.dropped_exits += other.dropped_exits
+
     def print_progress(self, sampling=50):
         """
         Print statistics about ongoing probing process.
@@ -22,6 +22,8 @@ Provide a Tor-specific SOCKSv5 interface.
 import os
 import struct
 import socket
+import asyncio
+import ipaddress
 import select
 import errno
 import logging
@@ -36,6 +38,12 @@ proxy_port = None
 queue      = None
 circ_id    = None
 
+# Probes authenticate to Tor's SOCKS port with a user name that contains their
+# circuit ID, so the event handler can attach their streams right away.
+
+SOCKS_USERNAME_PREFIX = "exitmap-"
+SOCKS_PASSWORD = "exitmap"
+
 _orig_getaddrinfo = socket.getaddrinfo
 orig_socket = socket.socket
 
@@ -69,6 +77,29 @@ socks5_errors = {
 }
 
 
+def socks_username(circ_id):
+    """
+    Return the SOCKS user name that isolates streams to the given circuit.
+    """
+
+    return "%s%s" % (SOCKS_USERNAME_PREFIX, circ_id)
+
+
+def username_circuit(username):
+    """
+    Return the circuit ID in the given SOCKS user name, or None.
+    """
+
+    if username is None:
+        return None
+
+    username = username.strip('"')
+    if not username.startswith(SOCKS_USERNAME_PREFIX):
+        return None
+
+    return username[len(SOCKS_USERNAME_PREFIX):] or None
+
+
 def send_queue(sock_name):
     """
     Inform caller about our newly created socket.
@@ -88,7 +119,8 @@ class _Torsocket(socks.socksocket):
                 # we are adding to the queue before as orig_neg will also do
                 # the actual connection to the destination inside.
                 # args[0] is the original socket to the proxy address
-                send_queue(args[0].getsockname())
+                if queue is not None:
+                    send_queue(args[0].getsockname())
                 orig_neg(*args, **kwargs)
             except Exception as e:
                 log.debug("Error in custom negotiation function: {}".format(e))
@@ -97,7 +129,9 @@ class _Torsocket(socks.socksocket):
     def negotiate(self):
         proxy_type, addr, port, rdns, username, password = self.proxy
         socks._BaseSocket.connect(self, (addr, port))
-        socks._BaseSocket.sendall(self, struct.pack('BBB', 0x05, 0x01, 0x00))
+        socks._BaseSocket.sendall(self, struct.pack('BBB', 0x05, 0x01, 0x02))
+        socks._BaseSocket.recv(self, 2)
+        socks._BaseSocket.sendall(self, _socks5_auth(username, password))
         socks._BaseSocket.recv(self, 2)
 
     def resolve(self, hostname):
@@ -105,7 +139,8 @@ class _Torsocket(socks.socksocket):
         host = hostname.encode("utf-8")
         # First connect to the local proxy
         self.negotiate()
-        send_queue(socks._BaseSocket.getsockname(self))
+        if queue is not None:
+            send_queue(socks._BaseSocket.getsockname(self))
         req = struct.pack('BBB', 0x05, 0xF0, 0x00)
         req += chr(0x03).encode() + chr(len(host)).encode() + host
         req = req + struct.pack(">H", 8444)
@@ -171,7 +206,9 @@ class MonkeyPatchedSocket(object):
     """
     Context manager which monkey-patches socket.socket with
     the above torsocket().  It also sets up this module's
-    global state.
+    global state.  If queue is None, new connections to Tor's
+    SOCKS port are not reported because the event handler
+    attaches streams by their SOCKS user name.
     """
     def __init__(self, queue, circ_id, socks_port, socks_addr="127.0.0.1"):
         self._queue           = queue
@@ -199,7 +236,8 @@ class MonkeyPatchedSocket(object):
         circ_id               = self._circ_id
         proxy_addr            = self._socks_addr
         proxy_port            = self._socks_port
-        socks.set_default_proxy(socks.SOCKS5, proxy_addr, proxy_port, True, None, None)
+        socks.set_default_proxy(socks.SOCKS5, proxy_addr, proxy_port, True,
+                                socks_username(circ_id), SOCKS_PASSWORD)
         socket.socket         = torsocket
         socket.getaddrinfo    = getaddrinfo
 
@@ -216,3 +254,133 @@ class MonkeyPatchedSocket(object):
         socket.getaddrinfo    = _orig_getaddrinfo
 
         return False
+
+
+def _socks5_auth(username, password):
+    """
+    Return the RFC 1929 user name and password authentication request.
+    """
+
+    username = username.encode("utf-8")
+    password = password.encode("utf-8")
+
+    return struct.pack("BB", 0x01, len(username)) + username + \
+        struct.pack("B", len(password)) + password
+
+
+def _socks5_address(host):
+    """
+    Return the SOCKSv5 address type and address of the given host.
+    """
+
+    try:
+        return struct.pack("B", 0x01) + ipaddress.IPv4Address(host).packed
+    except ValueError:
+        name = host.encode("idna")
+        return struct.pack("BB", 0x03, len(name)) + name
+
+
+async def _socks5_request(reader, writer, command, host, port, username):
+    """
+    Send a SOCKSv5 request to Tor and return its bound address.
+
+    Tor accepts any user name and password, so the greeting, the
+    authentication, and the request are sent at once.
+    """
+
+    writer.write(struct.pack("BBB", 0x05, 0x01, 0x02) +
+                 _socks5_auth(username, SOCKS_PASSWORD) +
+                 struct.pack("BBB", 0x05, command, 0x00) +
+                 _socks5_address(host) + struct.pack(">H", port))
+    await writer.drain()
+
+    version, method = struct.unpack("BB", await reader.readexactly(2))
+    if version != 0x05 or method != 0x02:
+        raise error.SOCKSv5Error("SOCKS server refused our greeting.")
+
+    version, status = struct.unpack("BB", await reader.readexactly(2))
+    if status != 0x00:
+        raise error.SOCKSv5Error("SOCKS server refused our credentials.")
+
+    version, reply, _, atype = struct.unpack("BBBB",
+                                             await reader.readexactly(4))
+    if version != 0x05:
+        raise error.SOCKSv5Error("SOCKS server error.")
+    if reply != 0x00:
+        raise error.SOCKSv5Error("SOCKS server error %d: %s" %
+                                 (reply, os.strerror(socks5_errors.get(
+                                     reply, errno.EIO))))
+
+    if atype == 0x01:
+        address = socket.inet_ntoa(await reader.readexactly(4))
+    elif atype == 0x03:
+        length = ord(await reader.readexactly(1))
+        address = (await reader.readexactly(length)).decode("utf-8")
+    elif atype == 0x04:
+        address = socket.inet_ntop(socket.AF_INET6,
+                                   await reader.readexactly(16))
+    else:
+        raise error.SOCKSv5Error("SOCKS server sent unknown address type.")
+    await reader.readexactly(2)
+
+    return address
+
+
+class TorConnector(object):
+
+    """
+    Open asyncio connections over Tor's SOCKS port.
+
+    Asynchronous modules get a connector instead of run_python_over_tor.  All
+    connections authenticate with the SOCKS user name of the given circuit.
+    Unless `on_connect' is None, it is called with the local address of every
+    new connection to Tor's SOCKS port, so that the event handler can attach
+    the resulting stream to the module's circuit.
+    """
+
+    def __init__(self, socks_port, circ_id, on_connect=None,
+                 socks_addr="127.0.0.1"):
+
+        self.socks_port = socks_port
+        self.socks_addr = socks_addr
+        self.username = socks_username(circ_id)
+        self.on_connect = on_connect
+
+    async def _connect(self):
+
+        reader, writer = await asyncio.open_connection(self.socks_addr,
+                                                       self.socks_port)
+        if self.on_connect is not None:
+            self.on_connect(writer.get_extra_info("sockname"))
+
+        return reader, writer
+
+    async def open_connection(self, host, port):
+        """
+        Return a (reader, writer) pair connected to host:port over Tor.
+        """
+
+        reader, writer = await self._connect()
+        try:
+            await _socks5_request(reader, writer, 0x01, host, port,
+                                  self.username)
+        except (error.SOCKSv5Error, asyncio.IncompleteReadError) as err:
+            writer.close()
+            raise error.SOCKSv5Error("Could not connect to %s:%d: %s" %
+                                     (host, port, err))
+
+        return reader, writer
+
+    async def resolve(self, host):
+        """
+        Resolve the given host name over Tor and return its address.
+        """
+
+        reader, writer = await self._connect()
+        try:
+            return await _socks5_request(reader, writer, 0xF0, host, 0,
+                                         self.username)
+        except asyncio.IncompleteReadError as err:
+            raise error.SOCKSv5Error("Could not resolve %s: %s" % (host, err))
+        finally:
+            writer.close()
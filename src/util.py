@@ -66,6 +66,26 @@ def parse_log_lines(ports, log_line):
         log.debug("Tor uses port %d as control port." % ports["control"])
 
 
+def parse_duration(duration):
+    """
+    Convert a duration such as "90", "45m", "6h", or "1d" to seconds.
+
+    A number without unit is interpreted as seconds.  A ValueError is raised if
+    the duration cannot be parsed.
+    """
+
+    units = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+    duration = str(duration).strip().lower()
+    match = re.match(r"^([0-9]+(?:\.[0-9]*)?)\s*([smhd]?)$", duration)
+    if not match:
+        raise ValueError("Invalid duration \"%s\"." % duration)
+
+    number, unit = match.groups()
+
+    return float(number) * units.get(unit or "s")
+
+
 def relay_in_consensus(fingerprint, cached_consensus_path):
     """
     Check if a relay is part of the consensus.
@@ -74,14 +94,27 @@ def relay_in_consensus(fingerprint, cached_consensus_path):
     True is returned.  If not, False is returned.
     """
 
-    fingerprint = fingerprint.upper()
+    return bool(relays_in_consensus([fingerprint], cached_consensus_path))
+
+
+def relays_in_consensus(fingerprints, cached_consensus_path):
+    """
+    Return the subset of the given relays that is part of the consensus.
+
+    The consensus is read only once, no matter how many relays we check.
+    """
+
+    wanted = set(fpr.upper() for fpr in fingerprints)
+    found = set()
 
     with DescriptorReader(cached_consensus_path) as reader:
         for descriptor in reader:
-            if descriptor.fingerprint == fingerprint:
-                return True
+            if descriptor.fingerprint in wanted:
+                found.add(descriptor.fingerprint)
+                if found == wanted:
+                    break
 
-    return False
+    return found
 
 
 def get_source_port(stream_line):
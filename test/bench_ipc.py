@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# Copyright 2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmark the IPC channel against the multiprocessing.Manager queue.
+
+A probe process sends a (circuit ID, socket name) message and waits until the
+event handler's side acknowledges it, which is what happens on the
+stream-attach path.  Run from the repository's root directory:
+
+    $ python3 test/bench_ipc.py [MESSAGES]
+"""
+
+import sys
+import time
+import multiprocessing
+sys.path.insert(0, 'src/')
+import ipc
+
+
+def probe(requests, replies, count):
+    for i in range(count):
+        requests.put((str(i), ("127.0.0.1", 1024 + i % 60000)))
+        replies.get()
+    requests.put((str(count), None))
+
+
+def bench(name, requests, replies, count):
+    proc = multiprocessing.get_context("fork").Process(
+        target=probe, args=(requests, replies, count))
+
+    start = time.perf_counter()
+    proc.start()
+    while True:
+        circ_id, sockname = requests.get()
+        if sockname is None:
+            break
+        replies.put((circ_id, None))
+    proc.join()
+    elapsed = time.perf_counter() - start
+
+    print("%-24s %8d messages  %8.0f messages/s  %6.1f us round trip" %
+          (name, count, count / elapsed, elapsed / count * 1e6))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    manager = multiprocessing.Manager()
+    bench("multiprocessing.Manager", manager.Queue(), manager.Queue(), count)
+    manager.shutdown()
+
+    bench("ipc.Channel", ipc.Channel(), ipc.Channel(), count)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# Copyright 2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+""" Unit tests for the checkpoint module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+import sys
+sys.path.insert(0, 'src/')
+import checkpoint
+
+
+class TestCheckpoint(unittest.TestCase):
+    """Test the checkpoint module."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = checkpoint.journal_path(self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_journal(self):
+        journal = checkpoint.Journal(self.path, "checktest")
+        journal.record("start")
+        journal.record("built", "A")
+        journal.record("done", "A")
+        journal.record("failed", "B")
+        journal.close()
+
+        records = checkpoint.read_journal(self.path)
+        self.assertEqual([r[1:] for r in records],
+                         [("start", "checktest", "-"),
+                          ("built", "checktest", "A"),
+                          ("done", "checktest", "A"),
+                          ("failed", "checktest", "B")])
+
+    def test_finished_exits(self):
+        self.assertEqual(checkpoint.finished_exits(self.path, "rtt"), set())
+
+        journal = checkpoint.Journal(self.path, "rtt")
+        journal.record("start")
+        journal.record("done", "A")
+        journal.close()
+
+        journal = checkpoint.Journal(self.path, "dnssec")
+        journal.record("start")
+        journal.record("done", "B")
+        journal.close()
+
+        # A truncated line must not break resuming.
+        with open(self.path, "a") as fd:
+            fd.write("1234.5 done rt")
+
+        self.assertEqual(checkpoint.finished_exits(self.path, "rtt"),
+                         set(["A"]))
+
+        journal = checkpoint.Journal(self.path, "rtt")
+        journal.record("start")
+        journal.close()
+        self.assertEqual(checkpoint.finished_exits(self.path, "rtt"), set())
+
+    def test_exit_history(self):
+        journal = checkpoint.Journal(self.path, "rtt")
+        journal.record("start")
+        journal.record("failed", "A")
+        journal.record("failed", "A")
+        journal.record("done", "B")
+        journal.close()
+
+        history = checkpoint.exit_history(self.path)
+        self.assertEqual(set(history.keys()), set(["A", "B"]))
+        self.assertEqual(history["A"], (0, 2))
+        self.assertTrue(history["B"][0] > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
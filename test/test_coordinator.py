@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# Copyright 2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+""" Unit tests for the coordinator module."""
+
+import threading
+import unittest
+import sys
+sys.path.insert(0, 'src/')
+import coordinator
+
+
+class TestLeaseTable(unittest.TestCase):
+    """Test the LeaseTable class."""
+
+    def setUp(self):
+        self.table = coordinator.LeaseTable(["A", "B", "C"], 2, 10)
+
+    def test_lease(self):
+        lease1, fprs1 = self.table.lease("w1", now=0)
+        lease2, fprs2 = self.table.lease("w2", now=0)
+        self.assertEqual(fprs1 + fprs2, ["A", "B", "C"])
+        self.assertEqual(self.table.lease("w3", now=0), (None, []))
+
+        self.assertTrue(self.table.complete(lease1, now=1))
+        self.assertFalse(self.table.finished())
+        self.assertTrue(self.table.complete(lease2, now=1))
+        self.assertTrue(self.table.finished())
+        self.assertEqual(self.table.done, set(["A", "B", "C"]))
+
+    def test_expiry(self):
+        lease1, _ = self.table.lease("w1", now=0)
+        self.assertTrue(self.table.renew(lease1, now=8))
+
+        lease2, fprs = self.table.lease("w2", now=15)
+        self.assertEqual(fprs, ["C"])
+
+        lease3, fprs = self.table.lease("w3", now=20)
+        self.assertEqual(fprs, ["A", "B"])
+        self.assertFalse(self.table.renew(lease1, now=20))
+        self.assertFalse(self.table.complete(lease1, now=20))
+
+
+class TestCoordinatorServer(unittest.TestCase):
+    """Test several workers talking to one coordinator."""
+
+    def test_workers(self):
+        fprs = ["%040X" % i for i in range(50)]
+        table = coordinator.LeaseTable(fprs, 3, 60)
+        server = coordinator.CoordinatorServer(table, ("127.0.0.1", 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:%d" % server.server_address[1]
+
+        scanned = []
+
+        def worker(name):
+            client = coordinator.LeaseClient(url, name)
+            while True:
+                reply = client.lease()
+                if reply["done"] or reply["lease"] is None:
+                    return
+                scanned.extend(reply["exits"])
+                self.assertTrue(client.renew(reply["lease"]))
+                self.assertTrue(client.complete(reply["lease"]))
+
+        workers = [threading.Thread(target=worker, args=("w%d" % i,))
+                   for i in range(4)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        server.shutdown()
+        server.server_close()
+
+        self.assertEqual(sorted(scanned), fprs)
+        self.assertTrue(table.finished())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# Copyright 2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+""" Unit tests for the exitmap module."""
+
+import types
+import asyncio
+import unittest
+import sys
+sys.path.insert(0, 'src/')
+import stem.exit_policy
+import exitmap
+
+
+def fake_module(name, destinations, calls):
+    module = types.ModuleType(name)
+    module.destinations = destinations
+
+    def probe(exit_desc, run_python_over_tor, run_cmd_over_tor,
+              destinations, **kwargs):
+        calls.append((name, destinations))
+
+    module.probe = probe
+    return module
+
+
+class TestModuleGroup(unittest.TestCase):
+    """Test the ModuleGroup class."""
+
+    def setUp(self):
+        self.calls = []
+        self.web = fake_module("web", [("127.0.0.1", 80)], self.calls)
+        self.ssh = fake_module("ssh", [("127.0.0.1", 22)], self.calls)
+        self.any = fake_module("any", None, self.calls)
+
+        self.exit_desc = types.SimpleNamespace(
+            fingerprint="A" * 40,
+            exit_policy=stem.exit_policy.ExitPolicy("accept *:80",
+                                                    "reject *:*"))
+
+    def test_destinations(self):
+        group = exitmap.ModuleGroup([self.web, self.ssh])
+        self.assertEqual(group.destinations, set([("127.0.0.1", 80),
+                                                  ("127.0.0.1", 22)]))
+
+        group = exitmap.ModuleGroup([self.web, self.any])
+        self.assertIsNone(group.destinations)
+
+    def test_probe(self):
+        group = exitmap.ModuleGroup([self.web, self.ssh, self.any])
+        group.probe(self.exit_desc, None, None,
+                    destinations=frozenset([("127.0.0.1", 80)]))
+
+        self.assertEqual([name for name, _ in self.calls], ["web", "any"])
+        self.assertEqual(self.calls[0][1], frozenset([("127.0.0.1", 80)]))
+
+
+    def test_async_probe(self):
+        async def probe(exit_desc, connector, destinations, **kwargs):
+            self.calls.append(("async", destinations))
+
+        self.web.probe = probe
+        group = exitmap.AsyncModuleGroup([self.web, self.ssh])
+        asyncio.run(group.probe(self.exit_desc, None,
+                                destinations=frozenset([("127.0.0.1", 80)])))
+
+        self.assertEqual(self.calls, [("async",
+                                       frozenset([("127.0.0.1", 80)]))])
+
+
+if __name__ == '__main__':
+    unittest.main()
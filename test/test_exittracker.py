@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Copyright 2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+""" Unit tests for the exittracker module."""
+
+import types
+import unittest
+import sys
+sys.path.insert(0, 'src/')
+import stem
+import stem.exit_policy
+import exittracker
+
+
+def fake_desc(fpr, digest, policy="accept *:*"):
+    return types.SimpleNamespace(
+        fingerprint=fpr,
+        digest=lambda: digest,
+        exit_policy=stem.exit_policy.ExitPolicy(policy))
+
+
+def fake_entry(fpr, flags=(stem.Flag.EXIT,)):
+    return types.SimpleNamespace(fingerprint=fpr, flags=frozenset(flags))
+
+
+class TestExitTracker(unittest.TestCase):
+    """Test the exittracker module."""
+
+    def setUp(self):
+        consensus = {"A": fake_entry("A"), "B": fake_entry("B")}
+        descriptors = {"A": fake_desc("A", "a1"), "B": fake_desc("B", "b1")}
+        self.tracker = exittracker.ExitTracker(consensus, descriptors, 100)
+
+    def test_select(self):
+        self.assertEqual(set(self.tracker.select()), set(["A", "B"]))
+
+        self.tracker.update_consensus([fake_entry("A")])
+        self.assertEqual(set(self.tracker.select()), set(["A"]))
+
+        self.tracker.update_descriptor(fake_desc("A", "a2", "reject *:*"))
+        self.assertEqual(self.tracker.select(), {})
+
+    def test_due(self):
+        self.assertEqual(self.tracker.due(["A", "B"], now=0), ["A", "B"])
+        self.assertIsNone(self.tracker.next_due(["A", "B"], now=0))
+
+        self.tracker.scanned(["A", "B"], now=0)
+        self.assertEqual(self.tracker.due(["A", "B"], now=50), [])
+        self.assertEqual(self.tracker.next_due(["A", "B"], now=50), 50)
+
+        self.tracker.update_descriptor(fake_desc("B", "b2"))
+        self.assertEqual(self.tracker.due(["A", "B"], now=50), ["B"])
+        self.assertEqual(self.tracker.due(["A", "B"], now=100), ["B", "A"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# Copyright 2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+""" Unit tests for the firsthop module."""
+
+import unittest
+import collections
+import sys
+sys.path.insert(0, 'src/')
+import firsthop
+
+Entry = collections.namedtuple("Entry", ["fingerprint", "address", "flags",
+                                         "bandwidth"])
+
+GUARD = ["Guard", "Fast", "Stable", "Running", "Valid"]
+
+
+class TestFirstHop(unittest.TestCase):
+    """Test the firsthop module."""
+
+    def setUp(self):
+        self.consensus = {
+            "A": Entry("A", "1.1.1.1", GUARD, 100),
+            "B": Entry("B", "2.2.2.2", GUARD, 300),
+            "C": Entry("C", "1.1.3.3", GUARD, 100),
+            "D": Entry("D", "4.4.4.4", ["Fast", "Running"], 1000),
+            "E": Entry("E", "5.5.5.5", ["Exit", "Running"], 100),
+        }
+
+    def test_parse_family(self):
+        family = ["$" + "a" * 40, "$" + "B" * 40 + "~nick", "nickname"]
+        self.assertEqual(firsthop.parse_family(family),
+                         set(["A" * 40, "B" * 40]))
+
+    def test_alias_table(self):
+        table = firsthop.AliasTable(["x", "y", "z"], [1, 3, 0])
+        draws = collections.Counter(table.draw() for _ in range(4000))
+        self.assertEqual(draws["z"], 0)
+        self.assertTrue(2000 < draws["y"] < 4000)
+
+        table = firsthop.AliasTable(["x", "y"], [0, 0])
+        self.assertEqual(set(table.draw() for _ in range(100)),
+                         set(["x", "y"]))
+
+        self.assertRaises(ValueError, firsthop.AliasTable, [], [])
+
+    def test_pool(self):
+        pool = firsthop.FirstHopPool(self.consensus)
+        self.assertEqual(len(pool), 3)
+
+        # C shares A's /16.
+
+        for _ in range(100):
+            self.assertIn(pool.draw("A"), ["B"])
+            self.assertNotEqual(pool.draw("E"), "D")
+
+    def test_family(self):
+        pool = firsthop.FirstHopPool(self.consensus, {"E": set(["A", "B"])})
+        for _ in range(100):
+            self.assertEqual(pool.draw("E"), "C")
+
+        pool = firsthop.FirstHopPool(self.consensus, {"B": set(["A"])})
+        self.assertIsNone(pool.draw("A"))
+
+
+    def test_balancer(self):
+        balancer = firsthop.FirstHopBalancer(["A", "B"])
+
+        # Circuits alternate while we know no latencies.
+
+        self.assertEqual(set([balancer.draw("E"), balancer.draw("E")]),
+                         set(["A", "B"]))
+        self.assertEqual(balancer.draw("A"), "B")
+
+    def test_balancer_latency(self):
+        balancer = firsthop.FirstHopBalancer(["A", "B"])
+        balancer.launched("1", balancer.draw("E"), 0)
+        balancer.launched("2", balancer.draw("E"), 0)
+        balancer.circuit_built("1")
+        balancer.circuit_built("2")
+        balancer.index["A"].latency = 10
+        balancer.index["B"].latency = 1
+
+        self.assertEqual(balancer.draw("E"), "B")
+        self.assertEqual(balancer.draw("E"), "B")
+
+    def test_balancer_drop(self):
+        balancer = firsthop.FirstHopBalancer(["A", "B"])
+        for i in range(firsthop.MIN_HISTORY):
+            balancer.launched(str(i), "A", 0)
+            balancer.index["A"].outstanding += 1
+            balancer.circuit_failed(str(i))
+
+        self.assertTrue(balancer.index["A"].dropped_until > 0)
+        for _ in range(10):
+            self.assertEqual(balancer.draw("E"), "B")
+
+        # If all first hops are dropped, we use them anyway.
+
+        self.assertEqual(balancer.draw("B"), "A")
+        self.assertIsNone(firsthop.FirstHopBalancer(["A"]).draw("A"))
+
+
+if __name__ == '__main__':
+    unittest.main()
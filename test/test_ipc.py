@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Copyright 2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+""" Unit tests for the ipc module."""
+
+import unittest
+import multiprocessing
+import sys
+sys.path.insert(0, 'src/')
+import ipc
+
+
+def send(channel, count):
+    for i in range(count):
+        channel.put((str(i), ("127.0.0.1", 1024 + i)))
+        channel.put((str(i), None))
+
+
+class TestIPC(unittest.TestCase):
+    """Test the ipc module."""
+
+    def setUp(self):
+        self.channel = ipc.Channel()
+
+    def tearDown(self):
+        self.channel.close_reader()
+
+    def test_messages(self):
+        self.channel.put(("42", ("127.0.0.1", 38662)))
+        self.channel.put(["42", None])
+
+        self.assertEqual(self.channel.get(), ("42", ("127.0.0.1", 38662)))
+        self.assertEqual(self.channel.get(), ("42", None))
+
+        self.assertRaises(ValueError, self.channel.put, ("foo", None))
+
+        self.channel.close()
+        self.assertRaises(EOFError, self.channel.get)
+
+    def test_processes(self):
+        procs = [multiprocessing.get_context("fork").Process(
+                    target=send, args=(self.channel, 100))
+                 for _ in range(2)]
+        for proc in procs:
+            proc.start()
+
+        messages = [self.channel.get() for _ in range(400)]
+        for proc in procs:
+            proc.join()
+
+        self.assertEqual(messages.count(("99", None)), 2)
+        self.assertEqual(messages.count(("0", ("127.0.0.1", 1024))), 2)
+        self.channel.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+# Copyright 2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+""" Unit tests for the ordering module."""
+
+import unittest
+import sys
+sys.path.insert(0, 'src/')
+import ordering
+
+
+class TestOrdering(unittest.TestCase):
+    """Test the ordering module."""
+
+    def setUp(self):
+        self.exits = ["A", "B", "C", "D"]
+
+    def test_random(self):
+        ordered = ordering.order_exits(self.exits, "random")
+        self.assertEqual(sorted(ordered), self.exits)
+
+    def test_bandwidth(self):
+        bandwidths = {"A": 10, "B": 300, "C": 20}
+        ordered = ordering.order_exits(self.exits, "bandwidth",
+                                       bandwidths=bandwidths)
+        self.assertEqual(ordered, ["B", "C", "A", "D"])
+
+    def test_history(self):
+        history = {"A": (300, 0), "B": (100, 5), "C": (200, 1)}
+
+        ordered = ordering.order_exits(self.exits, "last-probed",
+                                       history=history)
+        self.assertEqual(ordered, ["D", "B", "C", "A"])
+
+        ordered = ordering.order_exits(self.exits, "failures",
+                                       history=history)
+        self.assertEqual(set(ordered[:2]), set(["A", "D"]))
+        self.assertEqual(ordered[2:], ["C", "B"])
+
+
+if __name__ == '__main__':
+    unittest.main()
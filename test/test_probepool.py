@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# Copyright 2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+""" Unit tests for the probepool module."""
+
+import unittest
+import collections
+import multiprocessing
+import sys
+sys.path.insert(0, 'src/')
+import probepool
+
+Desc = collections.namedtuple("Desc", ["fingerprint"])
+
+
+class FakeModule(object):
+
+    def probe(self, exit_desc, run_python_over_tor, run_cmd_over_tor,
+              destinations=None):
+        if exit_desc.fingerprint == "bad":
+            raise ValueError("probe failed")
+
+
+class TestProbePool(unittest.TestCase):
+    """Test the probepool module."""
+
+    def setUp(self):
+        self.queue = multiprocessing.get_context("fork").Queue()
+        self.pool = probepool.ProbePool(FakeModule(), self.queue, 9050, 2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_pool(self):
+        for i, fpr in enumerate(["A", "bad", "B", "C"]):
+            self.pool.submit(str(i), Desc(fpr), None)
+
+        # Two jobs run and two wait for a worker.
+
+        self.assertEqual(len(self.pool.assignments), 2)
+        self.assertEqual(self.pool.busy(), 4)
+
+        finished = set()
+        while len(finished) < 4:
+            circ_id, sockname = self.queue.get(timeout=10)
+            self.assertIsNone(sockname)
+            finished.add(circ_id)
+            self.pool.done(circ_id)
+
+        self.assertEqual(finished, set(["0", "1", "2", "3"]))
+        self.assertEqual(self.pool.busy(), 0)
+        self.assertEqual(len(self.pool.idle), 2)
+
+
+class FakeAsyncModule(object):
+
+    async def probe(self, exit_desc, connector, destinations=None):
+        if exit_desc.fingerprint == "bad":
+            raise ValueError("probe failed")
+
+
+class TestProbeLoop(unittest.TestCase):
+    """Test the ProbeLoop class."""
+
+    def test_loop(self):
+        self.assertTrue(probepool.is_async(FakeAsyncModule()))
+        self.assertFalse(probepool.is_async(FakeModule()))
+
+        queue = multiprocessing.get_context("fork").Queue()
+        loop = probepool.ProbeLoop(FakeAsyncModule(), queue, 9050)
+        loop.submit("1", Desc("A"), None)
+        loop.submit("2", Desc("bad"), None)
+
+        finished = set()
+        while len(finished) < 2:
+            circ_id, sockname = queue.get(timeout=10)
+            finished.add(circ_id)
+            loop.done(circ_id)
+
+        self.assertEqual(loop.busy(), 0)
+        loop.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Copyright 2016 Philipp Winter <phw@nymity.ch>
+#
+# This file is part of exitmap.
+#
+# exitmap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# exitmap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
+""" Unit tests for the scheduler module."""
+
+import unittest
+import sys
+sys.path.insert(0, 'src/')
+import scheduler
+
+
+class TestScheduler(unittest.TestCase):
+    """Test the scheduler module."""
+
+    def setUp(self):
+        self.sched = scheduler.CircuitScheduler(0, initial_window=4,
+                                                max_window=8)
+
+    def launch(self, circ_id):
+        self.sched.launched(circ_id, self.sched.acquire())
+
+    def test_noisy_delay(self):
+        self.assertEqual(scheduler.noisy_delay(3, 0), 3)
+        for _ in range(100):
+            delay = scheduler.noisy_delay(1, 2)
+            self.assertTrue(0 <= delay < 3)
+
+    def test_additive_increase(self):
+        for i in range(4):
+            self.launch(str(i))
+        self.assertEqual(self.sched.in_flight, 4)
+
+        for i in range(4):
+            self.sched.circuit_built(str(i))
+        self.assertEqual(self.sched.in_flight, 0)
+        self.assertTrue(self.sched.window > 4)
+
+        for i in range(100):
+            self.launch(str(i))
+            self.sched.circuit_built(str(i))
+        self.assertEqual(self.sched.window, 8)
+
+    def test_multiplicative_decrease(self):
+        for i in range(4):
+            self.launch(str(i))
+        for i in range(4):
+            self.sched.circuit_failed(str(i))
+
+        self.assertEqual(self.sched.failure_ratio(), 1.0)
+        self.assertTrue(self.sched.congested())
+        self.assertEqual(self.sched.window, 2)
+        self.assertEqual(self.sched.failed, 4)
+
+    def test_early_event(self):
+        launch_time = self.sched.acquire()
+        self.sched.circuit_built("1")
+        self.assertEqual(self.sched.in_flight, 1)
+
+        self.sched.launched("1", launch_time)
+        self.assertEqual(self.sched.in_flight, 0)
+        self.assertEqual(self.sched.built, 1)
+
+    def test_estimate(self):
+        self.assertIsNone(self.sched.rate())
+        self.assertIsNone(self.sched.estimate(10))
+
+        self.launch("1")
+        self.sched.circuit_built("1")
+        self.sched.first_launch -= 1
+        self.assertTrue(self.sched.rate() > 0)
+        self.assertTrue(self.sched.estimate(10) > 0)
+
+
+    def test_probe_time(self):
+        self.launch("1")
+        self.sched.circuit_built("1")
+        self.sched.probe_finished("1")
+        self.assertTrue(self.sched.probe_time >= 0)
+        self.assertEqual(self.sched.probe_starts, {})
+
+    def test_fit_deadline(self):
+        sched = scheduler.CircuitScheduler(1, max_window=4)
+
+        # Without measurements, only the build delay limits us.
+
+        self.assertEqual(sched.fit_deadline(10, 100, now=0), 10)
+        self.assertAlmostEqual(sched.build_delay, 9)
+        self.assertEqual(sched.fit_deadline(1000, 100, now=0), 90)
+        self.assertEqual(sched.build_delay, 1)
+        self.assertEqual(sched.fit_deadline(10, 100, now=100), 0)
+
+        # Slow circuits and probes leave less time.
+
+        sched.latency = 10
+        sched.probe_time = 40
+        self.assertEqual(sched.fit_deadline(1000, 100, now=0), 18)
+
+
+if __name__ == '__main__':
+    unittest.main()
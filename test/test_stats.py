@@ -51,6 +51,18 @@ class TestStats(unittest.TestCase):
         self.stats.update_circs(circ_event)
         self.assertEqual(self.stats.successful_circuits, 1)
 
+    def test_merge(self):
+        other = stats.Statistics()
+        other.total_circuits = 10
+        other.failed_circuits = 2
+        other.finished_streams = 8
+
+        self.stats.total_circuits = 5
+        self.stats.merge(other)
+        self.assertEqual(self.stats.total_circuits, 15)
+        self.assertEqual(self.stats.failed_circuits, 2)
+        self.assertEqual(self.stats.finished_streams, 8)
+
 
 if __name__ == '__main__':
     unittest.main()
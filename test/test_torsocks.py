@@ -18,6 +18,8 @@
 # along with exitmap.  If not, see <http://www.gnu.org/licenses/>.
 """ Unit tests for the torsocks module."""
 
+import struct
+import asyncio
 import unittest
 import sys
 sys.path.insert(0, 'src/')
@@ -33,5 +35,50 @@ class TestTorsocks(unittest.TestCase):
                           ('127.0.0.1', 38662))
 
 
+    def test_connector(self):
+        requests = []
+        socknames = []
+
+        async def socks_server(reader, writer):
+            await reader.readexactly(3)
+            header = await reader.readexactly(5)
+            name = await reader.readexactly(header[4] + 2)
+            requests.append((header[1], name[:-2]))
+            if name[:-2] == b"fail.example.com":
+                writer.write(b"\x05\x00\x05\x04\x00\x01")
+            else:
+                writer.write(b"\x05\x00\x05\x00\x00\x01" +
+                             bytes([1, 2, 3, 4]) + struct.pack(">H", 0))
+            await writer.drain()
+            writer.write(b"hello")
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(socks_server, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            connector = torsocks.TorConnector(port, socknames.append)
+
+            reader, writer = await connector.open_connection(
+                "www.example.com", 80)
+            data = await reader.read()
+            writer.close()
+
+            address = await connector.resolve("www.example.com")
+
+            with self.assertRaises(SOCKSv5Error):
+                await connector.open_connection("fail.example.com", 80)
+
+            server.close()
+            return data, address
+
+        data, address = asyncio.run(run())
+        self.assertEqual(data, b"hello")
+        self.assertEqual(address, "1.2.3.4")
+        self.assertEqual(requests, [(0x01, b"www.example.com"),
+                                    (0xF0, b"www.example.com"),
+                                    (0x01, b"fail.example.com")])
+        self.assertEqual(len(socknames), 3)
+
+
 if __name__ == '__main__':
     unittest.main()
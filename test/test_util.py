@@ -56,6 +56,15 @@ class TestUtil(unittest.TestCase):
                                               "65535"), 65535)
         self.assertIsNone(util.get_source_port(""))
 
+    def test_parse_duration(self):
+        self.assertEqual(util.parse_duration("90"), 90)
+        self.assertEqual(util.parse_duration("1.5s"), 1.5)
+        self.assertEqual(util.parse_duration("45m"), 45 * 60)
+        self.assertEqual(util.parse_duration("6H"), 6 * 60 * 60)
+        self.assertEqual(util.parse_duration("1d"), 24 * 60 * 60)
+        self.assertRaises(ValueError, util.parse_duration, "")
+        self.assertRaises(ValueError, util.parse_duration, "5 minutes")
+
     def test_exiturl(self):
         self.assertEqual(util.exiturl("foo"), ("<https://metrics.torproject"
                                                ".org/rs.html#details/foo>"))